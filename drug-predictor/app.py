@@ -1,8 +1,13 @@
+import time
 import numpy as np
 import pandas as pd
 from scipy.integrate import solve_ivp
+from scipy.linalg import expm
+from scipy.sparse import csc_matrix
 from dataclasses import dataclass
 import yaml
+from cache import SimulationCache
+from nca import nca
 
 @dataclass
 class Physiology:
@@ -31,287 +36,745 @@ class DosingEvent:
     time: float
     duration: float = 0.0
 
+@dataclass
+class Tissue:
+    """A flow-limited compartment exchanging with Blood; clearance (L/h) acts on its concentration"""
+    name: str
+    volume: float
+    flow: float
+    kp: float = 1.0
+    clearance: float = 0.0
+
+@dataclass
+class Checkpoint:
+    """Integrated state at time, before any dose scheduled exactly at time.
+
+    events is the regimen the state was integrated under; continuing from the
+    checkpoint keeps its doses that fall after time.
+    """
+    time: float
+    state: np.ndarray
+    events: tuple
+
+GUT, BLOOD = 0, 1
+
+def default_tissues(phys: Physiology, cmpd: Compound):
+    """The built-in Liver/Muscle/Fat set parameterised by Physiology and Compound"""
+    return [Tissue('Liver', phys.V_liver, phys.Q_liver, cmpd.Kp_liver, phys.CLint_liver),
+            Tissue('Muscle', phys.V_muscle, phys.Q_muscle, cmpd.Kp_muscle),
+            Tissue('Fat', phys.V_fat, phys.Q_fat, cmpd.Kp_fat)]
+
+def load_tissues(cfg):
+    """Tissues declared under cfg['tissues'], or None to keep the built-in set"""
+    spec = cfg.get('tissues')
+    if not spec:
+        return None
+    tissues = [Tissue(**{k: v if k == 'name' else float(v) for k, v in t.items()}) for t in spec]
+    names = [t.name for t in tissues]
+    if len(set(names)) != len(names) or {'Gut', 'Blood'} & set(names):
+        raise ValueError(f"Tissue names must be unique and not Gut/Blood: {names}")
+    for t in tissues:
+        if t.volume <= 0 or t.kp <= 0 or t.flow < 0 or t.clearance < 0:
+            raise ValueError(f"Invalid parameters for tissue {t.name}")
+    return tissues
+
+def pk_rate_matrix(vols, flows, kps, clint, k_abs):
+    """Linear PK rate matrix A with dA/dt = A @ amounts for the flow-limited model.
+
+    Parameters may carry leading batch dimensions, e.g. (n_subjects, n_pk),
+    in which case a stack of matrices of shape (n_subjects, n_pk, n_pk) is built.
+    """
+    vols, flows, kps, clint, k_abs = np.broadcast_arrays(
+        *(np.asarray(v, dtype=float) for v in (vols, flows, kps, clint)),
+        np.asarray(k_abs, dtype=float)[..., None])
+    n = vols.shape[-1]
+    A = np.zeros(vols.shape + (n,))
+    T = slice(BLOOD + 1, None)
+    idx = np.arange(BLOOD + 1, n)
+    A[..., GUT, GUT] = -k_abs[..., 0]
+    A[..., BLOOD, GUT] = k_abs[..., 0]
+    # Blood <-> tissue exchange and intrinsic clearance from each tissue
+    out_rate = flows[..., T]/(vols[..., T]*kps[..., T])
+    A[..., BLOOD, BLOOD] = -flows[..., T].sum(-1)/vols[..., BLOOD]
+    A[..., BLOOD, T] = out_rate
+    A[..., T, BLOOD] = flows[..., T]/vols[..., BLOOD, None]
+    A[..., idx, idx] = -out_rate - clint[..., T]/vols[..., T]
+    return A
+
+DOSE_TYPES = ('iv_bolus', 'oral', 'iv_infusion')
+
+def check_dose(ev):
+    """Raise on a dose type other than DOSE_TYPES or an infusion without a positive duration"""
+    if ev.type not in DOSE_TYPES:
+        raise ValueError(f"dose type must be one of {DOSE_TYPES}, got {ev.type!r}")
+    if ev.type == 'iv_infusion' and not ev.duration > 0:
+        raise ValueError(f"iv_infusion at t={ev.time} needs a positive duration, got {ev.duration}")
+
+class DoseTimeline:
+    """A dosing list compiled once into sorted arrays.
+
+    Boluses and oral doses become (time, compartment, amount) arrays and
+    infusions a cumulative Blood input-rate step function over its sorted
+    breakpoints, so the input at any time is a searchsorted lookup instead of
+    a scan over every event. Iterating yields the original events.
+    """
+    def __init__(self, events):
+        self.events = list(events)
+        for ev in self.events:
+            check_dose(ev)
+        infusion = [ev.type == 'iv_infusion' for ev in self.events]
+        jumps = [ev for ev, inf in zip(self.events, infusion) if not inf]
+        order = np.argsort([ev.time for ev in jumps], kind='stable')
+        self.jump_times = np.array([jumps[i].time for i in order], dtype=float)
+        self.jump_comp = np.array([GUT if jumps[i].type == 'oral' else BLOOD for i in order], dtype=int)
+        self.jump_amounts = np.array([jumps[i].amount for i in order], dtype=float)
+        infs = [ev for ev, inf in zip(self.events, infusion) if inf]
+        r = np.array([ev.amount/ev.duration for ev in infs], dtype=float)
+        edges = np.concatenate([[ev.time for ev in infs], [ev.time + ev.duration for ev in infs]])
+        self.rate_times, idx = np.unique(edges, return_inverse=True)
+        steps = np.bincount(idx, weights=np.concatenate([r, -r]), minlength=len(self.rate_times))
+        rate = np.cumsum(steps)
+        # Summing +r and -r need not cancel exactly; clear the leftovers
+        rate[np.abs(rate) <= 1e-12*(np.abs(r).max() if len(r) else 0.0)] = 0.0
+        self.rate_values = rate
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __len__(self):
+        return len(self.events)
+
+    def infusion_rate(self, t):
+        """Total Blood infusion rate at time(s) t (right-continuous)"""
+        i = np.searchsorted(self.rate_times, t, side='right') - 1
+        return np.where(i >= 0, self.rate_values[np.maximum(i, 0)] if len(self.rate_values) else 0.0, 0.0)
+
+    def segments(self, t_start, t_end, n_pk, breaks=()):
+        bounds = np.unique(np.concatenate([[t_start, t_end], self.jump_times, self.rate_times,
+                                           np.fromiter(breaks, dtype=float)]))
+        bounds = bounds[(bounds >= t_start) & (bounds <= t_end)]
+        a, b = bounds[:-1], bounds[1:]
+        rates = np.zeros((len(a), n_pk))
+        rates[:, BLOOD] = self.infusion_rate(a)
+        jumps = np.zeros((len(a), n_pk))
+        k = np.searchsorted(a, self.jump_times)
+        hit = k < len(a)
+        hit[hit] = a[k[hit]] == self.jump_times[hit]
+        np.add.at(jumps, (k[hit], self.jump_comp[hit]), self.jump_amounts[hit])
+        return list(zip(a.tolist(), b.tolist(), jumps, rates))
+
+def dose_segments(events, t_start, t_end, n_pk, breaks=()):
+    """Split [t_start, t_end) at dose times into (start, end, jump, rate) pieces.
+
+    Boluses and oral doses are exact jumps in Blood/Gut at the segment start,
+    infusions a constant Blood input rate over the segments they cover.
+    events may be a list of DosingEvent or an already compiled DoseTimeline;
+    breaks are extra split times (e.g. checkpoints) without a dose.
+    """
+    timeline = events if isinstance(events, DoseTimeline) else DoseTimeline(events)
+    return timeline.segments(t_start, t_end, n_pk, breaks)
+
+# Solver selection for method='auto'
+IMPLICIT_METHODS = ('Radau', 'BDF', 'LSODA')
+STIFF_STEPS = 200       # fastest rate x time span above which explicit RK is step-limited
+SPARSE_JAC_MIN = 20     # states from which BDF/Radau get a sparse Jacobian
+# The expm PK block is exact; keep the receptor solve it drives from being the error floor
+EXPM_QSP_SOLVER = {'method': 'LSODA', 'rtol': 1e-9, 'atol': 1e-12}
+
+BINDING_MODES = ('full', 'qss')
+
+def time_grid(t_start, t_end, dt, origin=None):
+    """Samples every dt within [t_start, t_end] on the grid through origin (default t_start)"""
+    origin = t_start if origin is None else origin
+    k0 = int(np.ceil((t_start - origin)/dt - 1e-9))
+    n_steps = int(np.floor((t_end - origin)/dt + 1e-9))
+    return np.maximum(origin + dt*np.arange(k0, n_steps + 1), t_start)
+
 class PBPKQSPSimulator:
-    def __init__(self, phys: Physiology, cmpd: Compound, qsp_params=None):
+    def __init__(self, phys: Physiology, cmpd: Compound, qsp_params=None, tissues=None, binding='full'):
+        if binding not in BINDING_MODES:
+            raise ValueError(f"binding must be one of {BINDING_MODES}, got {binding!r}")
         self.phys = phys
         self.cmpd = cmpd
         self.qsp = qsp_params
-        self.names = ['Gut','Blood','Liver','Muscle','Fat']
-        self.vols = [1.0, phys.V_blood, phys.V_liver, phys.V_muscle, phys.V_fat]
-        self.flows = [0.0, 0.0, phys.Q_liver, phys.Q_muscle, phys.Q_fat]
-        self.kps   = [1.0, 1.0, cmpd.Kp_liver, cmpd.Kp_muscle, cmpd.Kp_fat]
-        self.clint = [0.0, 0.0, phys.CLint_liver, 0.0, 0.0]
+        # qss replaces the receptor ODEs by their binding equilibrium
+        self.binding = binding
+        self.reduced = bool(qsp_params) and binding != 'full'
+        # Gut and Blood are fixed; any number of tissues hang off Blood
+        self.tissues = list(tissues) if tissues else default_tissues(phys, cmpd)
+        self.names = ['Gut', 'Blood'] + [t.name for t in self.tissues]
+        self.vols = [1.0, phys.V_blood] + [t.volume for t in self.tissues]
+        self.flows = [0.0, 0.0] + [t.flow for t in self.tissues]
+        self.kps   = [1.0, 1.0] + [t.kp for t in self.tissues]
+        self.clint = [0.0, 0.0] + [t.clearance for t in self.tissues]
         self.n_pk = len(self.names)
-        self.n_qsp = 3 if qsp_params else 0
-
-    def odes(self, t, y, events):
-        inj = np.zeros(self.n_pk)
-        for ev in events:
-            if ev.type=='iv_bolus' and abs(t-ev.time)<self.dt/2:
-                inj[1] += ev.amount/self.dt
-            elif ev.type=='iv_infusion' and ev.time <= t < ev.time+ev.duration:
-                inj[1] += ev.amount/ev.duration
-            elif ev.type=='oral' and abs(t-ev.time)<self.dt/2:
-                inj[0] += ev.amount/self.dt
-
-        Agut, Ab, Aliv, Amusc, Afat = y[:5]
-        dAgut = -self.cmpd.k_abs*Agut + inj[0]
-        Cb = Ab/self.vols[1]
-        dAb = self.cmpd.k_abs*Agut + inj[1]
-        dAliv = dAmusc = dAfat = 0.0
-        for idx, (vol, flow, kp, cl) in enumerate(zip(self.vols, self.flows, self.kps, self.clint)):
-            if idx<2: continue
-            Ci = y[idx]/vol
-            flux = flow*(Cb - Ci/kp)
-            dAb   -= flux
-            if idx==2: dAliv = flux - cl*Ci
-            elif idx==3: dAmusc = flux
-            elif idx==4: dAfat  = flux
-
-        dPK = [dAgut, dAb, dAliv, dAmusc, dAfat]
+        self.n_qsp = (1 if self.reduced else 3) if qsp_params else 0
+        # Precomputed structure: the PK block is linear, so the RHS is A @ y
+        self.A = pk_rate_matrix(self.vols, self.flows, self.kps, self.clint, cmpd.k_abs)
+        self.inv_vb = 1.0/phys.V_blood
+        self._props = {}
+        self._jac = np.zeros((self.n_pk + self.n_qsp,)*2)
+        self._jac[:self.n_pk, :self.n_pk] = self.A
+        if self.reduced:
+            self._jac[self.n_pk, self.n_pk] = -self.qsp[4]
+        elif self.qsp:
+            kon, koff, Rtot, kprod, kdeg = self.qsp
+            q = slice(self.n_pk, self.n_pk + 3)
+            self._jac[q, q] = [[0.0, koff, 0.0],
+                               [0.0, -koff, 0.0],
+                               [0.0, kprod, -kdeg]]
+        self._sparse = None
+        self._marks = ()
+        self.checkpoints = []
+
+    def odes(self, t, y, inj):
+        """RHS for one dosing segment; inj is the constant infusion-rate vector"""
+        dPK = self.A @ y[:self.n_pk] + inj
 
         if self.qsp:
-            kon, koff, Rtot, kprod, kdeg = self.qsp
-            Rf, Rc, M = y[5:8]
-            bind = kon*Cb*Rf - koff*Rc
-            dRf = -bind
-            dRc = bind
-            dM  = kprod*Rc - kdeg*M
-            return dPK + [dRf, dRc, dM]
+            Cb = y[BLOOD]*self.inv_vb
+            return np.concatenate((dPK, self.qsp_rates(Cb, y[self.n_pk:])))
 
         return dPK
 
-    def simulate(self, events, t_end=24.0, dt=0.1):
-        y0 = [0.0]*self.n_pk
-        if self.qsp:
-            y0 += [self.qsp[2], 0.0, 0.0]
-        self.dt = dt
-        t_eval = np.arange(0, t_end+dt, dt)
-        sol = solve_ivp(
-            fun=lambda t,y: self.odes(t,y,events),
-            t_span=(0, t_end), y0=y0, t_eval=t_eval, method='RK45'
-        )
+    def qsp_rates(self, Cb, z):
+        """Receptor binding and biomarker turnover driven by blood concentration Cb"""
+        kon, koff, Rtot, kprod, kdeg = self.qsp
+        if self.reduced:
+            Rc, _ = self.bound_complex(Cb)
+            return (kprod*Rc - kdeg*z[0],)
+        Rf, Rc, M = z.tolist()
+        bind = kon*Cb*Rf - koff*Rc
+        return (-bind, bind, kprod*Rc - kdeg*M)
+
+    def bound_complex(self, Cb):
+        """Equilibrium Drug_Receptor_Complex and its slope in Cb under qss binding.
+
+        Cb is the free ligand, as in the full model (binding does not deplete
+        drug), so Rc = Rtot*Cb/(Kd + Cb).
+        """
+        kon, koff, Rtot, kprod, kdeg = self.qsp
+        Kd = koff/kon
+        return Rtot*Cb/(Kd + Cb), Rtot*Kd/(Kd + Cb)**2
+
+    def jac(self, t, y):
+        """Analytic Jacobian of odes; only the receptor-binding rows depend on y"""
+        J = self._jac.copy()
+        if self.reduced:
+            _, dRc = self.bound_complex(y[BLOOD]*self.inv_vb)
+            J[self.n_pk, BLOOD] = self.qsp[3]*dRc*self.inv_vb
+        elif self.qsp:
+            kon = self.qsp[0]
+            Cb = y[BLOOD]*self.inv_vb
+            Rf = y[self.n_pk]
+            rf, rc = self.n_pk, self.n_pk + 1
+            J[rf, BLOOD] = -kon*Rf*self.inv_vb
+            J[rc, BLOOD] = kon*Rf*self.inv_vb
+            J[rf, rf] = -kon*Cb
+            J[rc, rf] = kon*Cb
+        return J
+
+    def jac_sparsity(self):
+        """Nonzero pattern of jac: compartment connectivity plus the receptor couplings"""
+        P = self._jac != 0
+        if self.reduced:
+            P[self.n_pk, BLOOD] = True
+        elif self.qsp:
+            rf, rc = self.n_pk, self.n_pk + 1
+            P[[rf, rc], BLOOD] = P[[rf, rc], rf] = True
+        return P
+
+    def sparse_jac(self, t, y):
+        """jac as a CSC matrix filled straight from the connectivity pattern"""
+        if self._sparse is None:
+            S = csc_matrix(self.jac_sparsity().astype(float))
+            rows = S.indices
+            cols = np.repeat(np.arange(S.shape[1]), np.diff(S.indptr))
+            pos = {(r, c): k for k, (r, c) in enumerate(zip(rows.tolist(), cols.tolist()))}
+            var = []
+            if self.reduced:
+                var = [pos[self.n_pk, BLOOD]]
+            elif self.qsp:
+                rf, rc = self.n_pk, self.n_pk + 1
+                var = [pos[rf, BLOOD], pos[rc, BLOOD], pos[rf, rf], pos[rc, rf]]
+            self._sparse = (self._jac[rows, cols], S.indices, S.indptr, var)
+        base, indices, indptr, var = self._sparse
+        data = base.copy()
+        if self.reduced:
+            _, dRc = self.bound_complex(y[BLOOD]*self.inv_vb)
+            data[var] = self.qsp[3]*dRc*self.inv_vb
+        elif self.qsp:
+            kon = self.qsp[0]
+            Cb = y[BLOOD]*self.inv_vb
+            dRf = kon*y[self.n_pk]*self.inv_vb
+            data[var] = [-dRf, dRf, -kon*Cb, kon*Cb]
+        n = len(indptr) - 1
+        return csc_matrix((data, indices, indptr), shape=(n, n))
+
+    def _jac_kw(self, method):
+        """Jacobian argument for solve_ivp; explicit Runge-Kutta methods take none"""
+        if method not in IMPLICIT_METHODS:
+            return {}
+        # LSODA only accepts a dense Jacobian
+        sparse = method != 'LSODA' and self.n_pk + self.n_qsp >= SPARSE_JAC_MIN
+        return {'jac': self.sparse_jac if sparse else self.jac}
+
+    @staticmethod
+    def _stiffness(J):
+        rates = -np.linalg.eigvals(J).real
+        rates = rates[rates > 1e-12*max(rates.max(), 1.0)] if len(rates) else rates
+        if not len(rates):
+            return 1.0, 0.0
+        return rates.max()/rates.min(), rates.max()
+
+    def stiffness(self, y=None):
+        """(stiffness ratio, fastest decay rate) from the Jacobian eigenvalues at state y"""
+        return self._stiffness(self.jac(0.0, self.initial_state() if y is None else y))
+
+    def auto_method(self, events, t_span, allow_expm=True):
+        """Pick a solver: expm where the PK block can be stepped exactly, else by stiffness.
+
+        Stiffness is judged at the largest single dose sitting in Blood, where
+        the receptor binding rate kon*Cb is at its fastest. expm with the QSP
+        block on still integrates that block explicitly, so it is only chosen
+        when the receptor block alone is non-stiff.
+        """
+        y = self.initial_state()
+        y[BLOOD] = max([ev.amount for ev in events], default=0.0)
+        J = self.jac(0.0, y)
+        if allow_expm:
+            if not self.qsp:
+                return 'expm'
+            q = slice(self.n_pk, None)
+            if self._blood_modes() is not None and self._stiffness(J[q, q])[1]*t_span <= STIFF_STEPS:
+                return 'expm'
+        if self._stiffness(J)[1]*t_span <= STIFF_STEPS:
+            return 'RK45'
+        return 'BDF' if self.n_pk + self.n_qsp >= SPARSE_JAC_MIN else 'LSODA'
+
+    def initial_state(self):
+        y0 = np.zeros(self.n_pk + self.n_qsp)
+        if self.qsp and not self.reduced:
+            y0[self.n_pk] = self.qsp[2]
+        return y0
+
+    def to_state(self, y):
+        """A state- or output-width vector as the integrated state"""
+        y = np.array(y, dtype=float)
+        if self.reduced and len(y) == self.n_pk + 3:
+            return np.concatenate((y[:self.n_pk], y[-1:]))
+        return y
+
+    def outputs(self, Y):
+        """States to output columns; reduced binding fills the receptor columns back in"""
+        if not self.reduced:
+            return Y
+        Rc, _ = self.bound_complex(Y[..., BLOOD]*self.inv_vb)
+        return np.concatenate((Y[..., :self.n_pk], (self.qsp[2] - Rc)[..., None], Rc[..., None],
+                               Y[..., self.n_pk:]), axis=-1)
+
+    def _integrate(self, events, t_end, dt, method='RK45', t_start=0.0, y0=None, checkpoints=None,
+                   origin=None):
+        """Integrate segment by segment and sample every output column on the dt grid.
+
+        The grid runs through origin (default t_start). Given checkpoints
+        (times), self.checkpoints is replaced by the states at those times and
+        at t_end; otherwise it is left as it was.
+        """
+        if method == 'auto':
+            method = self.auto_method(events, t_end - t_start)
+        self.method = method
+        y0 = None if y0 is None else self.to_state(y0)
+        if checkpoints is not None:
+            self.checkpoints = []
+            self._events = tuple(events)
+            self._marks = {float(c) for c in checkpoints if t_start <= c <= t_end} | {float(t_end)}
+        try:
+            if method == 'expm':
+                t, Y = self._integrate_expm(events, t_end, dt, t_start, y0, origin)
+            else:
+                t, Y = self._integrate_ode(events, t_end, dt, method, t_start, y0, origin)
+        finally:
+            self._marks = ()
+        return t, self.outputs(Y)
+
+    def _record(self, t, y):
+        if t in self._marks:
+            self.checkpoints.append(Checkpoint(t, np.array(y, dtype=float), self._events))
+
+    def _integrate_ode(self, events, t_end, dt, method, t_start=0.0, y0=None, origin=None):
+        t_eval = time_grid(t_start, t_end, dt, origin)
+        Y = np.empty((len(t_eval), self.n_pk + self.n_qsp))
+        y = self.initial_state() if y0 is None else np.array(y0, dtype=float)
+        kw = self._jac_kw(method)
+        self.nfev = 0
+        for a, b, jump, rate in dose_segments(events, t_start, t_end, self.n_pk, self._marks):
+            self._record(a, y)
+            y[:self.n_pk] += jump
+            lo, hi = np.searchsorted(t_eval, [a, b])
+            sol = solve_ivp(
+                fun=lambda t, y, rate=rate: self.odes(t, y, rate),
+                t_span=(a, b), y0=y, t_eval=np.append(t_eval[lo:hi], b),
+                method=method, **kw
+            )
+            self.nfev += sol.nfev
+            Y[lo:hi] = sol.y[:, :-1].T
+            y = sol.y[:, -1]
+        self._record(float(t_end), y)
+        if np.isclose(t_eval[-1], t_end):
+            Y[-1] = y
+        return t_eval, Y
+
+    def propagator(self, h):
+        """Exact PK step over h for a constant input: x(t+h) = Phi @ x(t) + Gam @ rate"""
+        key = round(h, 12)
+        P = self._props.get(key)
+        if P is None:
+            n = self.n_pk
+            M = np.zeros((2*n, 2*n))
+            M[:n, :n] = self.A*h
+            M[:n, n:] = np.eye(n)*h
+            E = expm(M)
+            P = self._props[key] = (E[:n, :n], E[:n, n:])
+        return P
+
+    def auc_propagator(self, h):
+        """Exact PK integral over h: int x = Gam @ x(t) + Psi @ rate (Gam as in propagator)"""
+        key = ('auc', round(h, 12))
+        P = self._props.get(key)
+        if P is None:
+            n = self.n_pk
+            M = np.zeros((3*n, 3*n))
+            M[:n, :n] = self.A*h
+            M[:n, n:2*n] = M[n:2*n, 2*n:] = np.eye(n)*h
+            E = expm(M)
+            P = self._props[key] = (E[:n, n:2*n], E[:n, 2*n:])
+        return P
+
+    def pk_auc(self, events, t_end, t_start=0.0, y0=None):
+        """Exact AUC over [t_start, t_end] of every PK column, independent of any output grid"""
+        x = (self.initial_state() if y0 is None else self.to_state(y0))[:self.n_pk]
+        auc = np.zeros(self.n_pk)
+        for a, b, jump, rate in dose_segments(events, t_start, t_end, self.n_pk):
+            x = x + jump
+            Gam, Psi = self.auc_propagator(b - a)
+            auc += Gam @ x + Psi @ rate
+            Phi, _ = self.propagator(b - a)
+            x = Phi @ x + Gam @ rate
+        return auc
+
+    def frame(self, t, Y, auc=None):
+        """Output DataFrame, or (DataFrame, {PK column: exact AUC}) when auc is given"""
+        df = pd.DataFrame(Y, columns=self.columns())
+        df.insert(0, 'Time_h', t)
+        if auc is None:
+            return df
+        return df, dict(zip(self.names, np.asarray(auc).tolist()))
+
+    def _blood_modes(self):
+        """Eigen-decomposition of A projected on Blood concentration, or None if defective"""
+        if not hasattr(self, '_modes'):
+            lam, V = np.linalg.eig(self.A)
+            self._modes = None
+            if np.linalg.cond(V) < 1e10:
+                self._modes = (lam, V[BLOOD]*self.inv_vb, np.linalg.inv(V))
+        return self._modes
+
+    def _blood_conc(self, a, x, rate):
+        """Exact Cb(t) on a dosing segment starting at a with PK state x"""
+        lam, vb, Vinv = self._blood_modes()
+        c0, g = Vinv @ x, Vinv @ rate
+        nz = lam != 0
+        lam_nz = np.where(nz, lam, 1.0)
+        def cb(t):
+            tau = t - a
+            phi = np.where(nz, np.expm1(lam_nz*tau)/lam_nz, tau)
+            return float(np.real(vb @ (np.exp(lam*tau)*c0 + g*phi)))
+        return cb
+
+    def _integrate_expm(self, events, t_end, dt, t_start=0.0, y0=None, origin=None):
+        """Advance the linear PK block exactly with cached matrix exponentials.
+
+        The receptor block, if any, is integrated per segment against the
+        closed-form (modal) Blood concentration of that segment.
+        """
+        if self.qsp and self._blood_modes() is None:
+            return self._integrate_ode(events, t_end, dt, 'LSODA', t_start, y0, origin)
+        t_eval = time_grid(t_start, t_end, dt, origin)
+        Y = np.empty((len(t_eval), self.n_pk + self.n_qsp))
+        y = self.initial_state() if y0 is None else np.array(y0, dtype=float)
+        x, z = y[:self.n_pk], y[self.n_pk:]
+        Phi, Gam = self.propagator(dt)
+        self.nfev = 0
+        for a, b, jump, rate in dose_segments(events, t_start, t_end, self.n_pk, self._marks):
+            self._record(a, np.concatenate((x, z)))
+            x = x + jump
+            x_a = x
+            lo, hi = np.searchsorted(t_eval, [a, b])
+            t = a
+            if lo < hi:
+                P0, G0 = self.propagator(t_eval[lo] - a)
+                x = Y[lo, :self.n_pk] = P0 @ x + G0 @ rate
+                step = Gam @ rate
+                for k in range(lo + 1, hi):
+                    x = Y[k, :self.n_pk] = Phi @ x + step
+                t = t_eval[hi - 1]
+            P1, G1 = self.propagator(b - t)
+            x = P1 @ x + G1 @ rate
+            if self.qsp:
+                sol = solve_ivp(
+                    fun=lambda t, z, cb=self._blood_conc(a, x_a, rate): self.qsp_rates(cb(t), z),
+                    t_span=(a, b), y0=z, t_eval=np.append(t_eval[lo:hi], b), **EXPM_QSP_SOLVER
+                )
+                self.nfev += sol.nfev
+                Y[lo:hi, self.n_pk:] = sol.y[:, :-1].T
+                z = sol.y[:, -1]
+        self._record(float(t_end), np.concatenate((x, z)))
+        if np.isclose(t_eval[-1], t_end):
+            Y[-1] = np.concatenate((x, z))
+        return t_eval, Y
+
+    def columns(self):
         cols = self.names.copy()
         if self.qsp:
             cols += ['Free_Receptor','Drug_Receptor_Complex','Biomarker']
-        df = pd.DataFrame(sol.y.T, columns=cols)
-        df.insert(0, 'Time_h', sol.t)
-        return df
-
-def compute_pk_metrics(df, comp='Blood'):
-    conc = df[comp]
-    time = df['Time_h']
-    cmax = np.max(conc)
-    tmax = time[np.argmax(conc)]
-    auc = np.trapz(conc, time)
-    return {'Cmax': cmax, 'Tmax': tmax, 'AUC': auc}
+        return cols
+
+    def state_columns(self):
+        """Names of the integrated states (the receptor pair is algebraic under qss)"""
+        return self.names + ['Biomarker'] if self.reduced else self.columns()
+
+    def simulate(self, events, t_end=24.0, dt=0.1, method='RK45', checkpoints=None, return_auc=False):
+        """Sampled trajectories; with checkpoints (times), states there are kept in self.checkpoints.
+
+        With return_auc, also returns the exact AUC of each PK column over the
+        frame (see pk_auc) for compute_pk_metrics(df, comp, auc=auc[comp]).
+        """
+        t, Y = self._integrate(events, t_end, dt, method=method, checkpoints=checkpoints)
+        return self.frame(t, Y, self.pk_auc(events, t[-1]) if return_auc else None)
+
+    def latest_checkpoint(self, t):
+        """The last saved checkpoint at or before t, or None"""
+        before = [c for c in self.checkpoints if c.time <= t]
+        return max(before, key=lambda c: c.time) if before else None
+
+    def continue_from(self, checkpoint, new_events=(), t_end=24.0, dt=0.1, method='RK45', checkpoints=(),
+                      return_auc=False):
+        """Integrate only [checkpoint.time, t_end] under the checkpoint's regimen plus new_events.
+
+        Doses at checkpoint.time are applied; new doses before it cannot be
+        and raise. The frame holds the samples of the original t=0 dt grid from
+        checkpoint.time on. self.checkpoints keeps those at or before
+        checkpoint.time and gains t_end plus checkpoints, so updates can be
+        chained. return_auc is as in simulate, over [checkpoint.time, t_end].
+        """
+        new_events = list(new_events)
+        late = [ev.time for ev in new_events if ev.time < checkpoint.time]
+        if late:
+            raise ValueError(f"dose at t={min(late)} precedes the checkpoint at t={checkpoint.time}; "
+                             f"continue from an earlier checkpoint")
+        y0 = self.to_state(checkpoint.state)
+        if len(y0) != self.n_pk + self.n_qsp:
+            raise ValueError(f"checkpoint has {len(y0)} states, this model integrates {self.n_pk + self.n_qsp}")
+        events = list(checkpoint.events) + new_events
+        kept = [c for c in self.checkpoints if c.time <= checkpoint.time]
+        t, Y = self._integrate(events, t_end, dt, method=method, t_start=checkpoint.time, y0=y0,
+                               checkpoints=checkpoints, origin=0.0)
+        new = {c.time for c in self.checkpoints}
+        self.checkpoints = [c for c in kept if c.time not in new] + self.checkpoints
+        return self.frame(t, Y, self.pk_auc(events, t[-1], checkpoint.time, y0) if return_auc else None)
+
+    def simulate_summary(self, events, t_end=24.0, method='LSODA', comp='Blood', t_start=0.0, y0=None):
+        """Cmax/Tmax/AUC of comp without sampling a time grid.
+
+        AUC (and, with the QSP block, the receptor-complex and occupancy
+        integrals) are integrated as extra states; local maxima of comp come
+        from a solver event on its derivative, and segment boundaries are
+        checked for the jumps of bolus doses. Memory use is independent of
+        t_end and of any output resolution. The default is LSODA: explicit RK
+        takes few, stability-limited steps on the stiff PK block and its dense
+        output misplaces the peak.
+        """
+        if method == 'auto':
+            method = self.auto_method(events, t_end - t_start, allow_expm=False)
+        if method == 'expm':
+            raise ValueError("simulate_summary needs an ODE method, not 'expm'")
+        n = self.n_pk + self.n_qsp
+        if comp not in self.state_columns():
+            raise ValueError(f"{comp} is not an integrated state with binding={self.binding!r}")
+        c = self.state_columns().index(comp)
+        rc = self.n_pk + 1
+        y = self.initial_state() if y0 is None else self.to_state(y0)
+        y = np.concatenate((y, np.zeros(2 if self.qsp else 1)))
+        implicit = method in IMPLICIT_METHODS
+        cmax, tmax = y[c], t_start
+        self.nfev = 0
+
+        def complex_(y):
+            return self.bound_complex(y[BLOOD]*self.inv_vb)[0] if self.reduced else y[rc]
+
+        def rhs(t, y, rate):
+            dy = self.odes(t, y[:n], rate)
+            return np.concatenate((dy, (y[c], complex_(y)) if self.qsp else (y[c],)))
+
+        def jac(t, y):
+            J = np.zeros((len(y), len(y)))
+            J[:n, :n] = self.jac(t, y[:n])
+            J[n, c] = 1.0
+            if self.reduced:
+                J[n + 1, BLOOD] = self.bound_complex(y[BLOOD]*self.inv_vb)[1]*self.inv_vb
+            elif self.qsp:
+                J[n + 1, rc] = 1.0
+            return J
+
+        for a, b, jump, rate in dose_segments(events, t_start, t_end, self.n_pk):
+            y[:self.n_pk] += jump
+            if y[c] > cmax:
+                cmax, tmax = y[c], a
+            peak = lambda t, y, rate=rate: self.odes(t, y[:n], rate)[c]
+            peak.direction = -1
+            sol = solve_ivp(
+                fun=lambda t, y, rate=rate: rhs(t, y, rate),
+                t_span=(a, b), y0=y, t_eval=[b], events=peak, method=method,
+                **({'jac': jac} if implicit else {})
+            )
+            self.nfev += sol.nfev
+            for te, ye in zip(sol.t_events[0], sol.y_events[0]):
+                if ye[c] > cmax:
+                    cmax, tmax = ye[c], te
+            y = sol.y[:, -1]
+            if y[c] > cmax:
+                cmax, tmax = y[c], b
+        out = {'Cmax': cmax, 'Tmax': tmax, 'AUC': y[n]}
+        if self.qsp:
+            out['AUC_complex'] = y[n + 1]
+            out['AUC_occupancy'] = y[n + 1]/self.qsp[2]
+        out['final_state'] = self.outputs(y[:n])
+        return out
+
+    def binding_error(self, events, t_end=24.0, dt=0.1, method='LSODA'):
+        """Error of this qss model against full binding kinetics on the same regimen.
+
+        Returns per-column max absolute and relative (to the column's peak)
+        errors and the relative error of each column's AUC, plus RHS
+        evaluations and wall time of both models. The pointwise maxima include
+        the binding initial layer right after each dose, which the reduced
+        model skips by construction; the AUC error is the steadier measure.
+        """
+        full = PBPKQSPSimulator(self.phys, self.cmpd, self.qsp, self.tissues)
+        effort = {}
+        for label, sim in (('reduced', self), ('full', full)):
+            t0 = time.perf_counter()
+            t, Y = sim._integrate(events, t_end, dt, method=method)
+            effort[label] = {'nfev': sim.nfev, 'seconds': time.perf_counter() - t0}
+            if label == 'reduced':
+                Y_red = Y
+        err = np.abs(Y_red - Y).max(axis=0)
+        peak = np.abs(Y).max(axis=0)
+        auc_red, auc = np.trapz(Y_red, t, axis=0), np.trapz(Y, t, axis=0)
+        errors = pd.DataFrame({'max_abs_error': err,
+                               'max_rel_error': err/np.where(peak > 0, peak, 1.0),
+                               'auc_rel_error': np.abs(auc_red - auc)/np.where(auc != 0, np.abs(auc), 1.0)},
+                              index=self.columns())
+        return {'errors': errors, 'effort': effort}
+
+def compute_pk_metrics(df, comp='Blood', dose=None, auc=None):
+    """NCA of one column; pass auc (simulate(..., return_auc=True)) to replace the trapezoid AUC"""
+    res = nca(df['Time_h'].to_numpy(), df[comp].to_numpy(), dose=dose, auc=auc)
+    pk = {k: float(v) for k, v in res.items()}
+    pk['AUC'] = pk['AUC_0_t']
+    return pk
 
 def load_config(path='pbpk_config.yaml'):
     with open(path, 'r') as f:
         cfg = yaml.safe_load(f)
     return cfg
 
-# Statistical Models
-from statsmodels.tsa.holtwinters import ExponentialSmoothing
-from statsmodels.tsa.arima.model import ARIMA
-from statsmodels.tsa.statespace.sarimax import SARIMAX
-from statsmodels.tsa.vector_ar.var_model import VAR
-from prophet import Prophet
-
-# Tree-Based & Ensemble Models
-from xgboost import XGBRegressor
-from lightgbm import LGBMRegressor
-from catboost import CatBoostRegressor
-from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor, ExtraTreesRegressor, HistGradientBoostingRegressor
-
-# Regression Models
-from sklearn.svm import SVR
-from sklearn.linear_model import Ridge, Lasso, BayesianRidge
-
-# Deep Learning Models
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import LSTM, GRU, Dense, Conv1D, Flatten
-from sklearn.preprocessing import MinMaxScaler
+@dataclass
+class ModelSetup:
+    """The model a config declares: physiology, compound, QSP parameters, regimen, tissues, binding"""
+    phys: Physiology
+    cmpd: Compound
+    qsp: tuple
+    events: list
+    tissues: list = None
+    binding: str = 'full'
+
+    def simulator(self, phys=None, qsp=True):
+        """PBPKQSPSimulator for this setup, optionally with another Physiology or PK only"""
+        return PBPKQSPSimulator(phys or self.phys, self.cmpd, qsp_params=self.qsp if qsp else None,
+                                tissues=self.tissues, binding=self.binding)
+
+def model_from_config(cfg=None):
+    """Parse the physiology, compound, qsp, dosing, tissues and qsp_binding sections"""
+    cfg = load_config() if cfg is None else cfg
+    return ModelSetup(
+        phys=Physiology(**{k: float(v) for k, v in cfg['physiology'].items()}),
+        cmpd=Compound(**{k: v if k == 'name' else float(v) for k, v in cfg['compound'].items()}),
+        qsp=tuple(float(v) for v in cfg['qsp'].values()) if cfg.get('qsp') else None,
+        events=[DosingEvent(**d) for d in cfg.get('dosing', [])],
+        tissues=load_tissues(cfg),
+        binding=cfg.get('qsp_binding', 'full'),
+    )
+
+# Forecasters are imported lazily by the registry
+from forecasters import ensemble_predict, multivariate_predict, configure_model_cache, configure_keras
+from backtest import Backtester
 import warnings
 warnings.filterwarnings('ignore')
 
-def pbpk_predict(phys, cmpd, qsp_tuple, dosing_events, t_end, dt):
-    sim = PBPKQSPSimulator(phys, cmpd, qsp_params=qsp_tuple)
-    df = sim.simulate(dosing_events, t_end=t_end, dt=dt)
-    pk = compute_pk_metrics(df, comp='Blood')
+def pbpk_predict(phys, cmpd, qsp_tuple, dosing_events, t_end, dt, cache=None, tissues=None, binding='full'):
+    sim = PBPKQSPSimulator(phys, cmpd, qsp_params=qsp_tuple, tissues=tissues, binding=binding)
+    # Only the Blood AUC is needed, so skip the dense time grid entirely
+    if cache is not None:
+        pk = cache.summarize(sim, dosing_events, t_end=t_end)
+    else:
+        pk = sim.simulate_summary(dosing_events, t_end=t_end)
     return pk['AUC']  # Example: use AUC as the prediction
 
-def ensemble_predict(time_series):
-    preds = []
-    # Holt-Winters
-    try:
-        model = ExponentialSmoothing(time_series)
-        fit = model.fit()
-        preds.append(fit.forecast(1)[0])
-    except Exception:
-        pass
-    # ARIMA
-    try:
-        model = ARIMA(time_series, order=(1,1,1))
-        fit = model.fit()
-        preds.append(fit.forecast(1)[0])
-    except Exception:
-        pass
-    # SARIMA
-    try:
-        model = SARIMAX(time_series, order=(1,1,1), seasonal_order=(1,1,1,12))
-        fit = model.fit(disp=False)
-        preds.append(fit.forecast(1)[0])
-    except Exception:
-        pass
-    # VAR (requires multivariate)
-    try:
-        if isinstance(time_series, pd.DataFrame) and time_series.shape[1] > 1:
-            model = VAR(time_series)
-            fit = model.fit()
-            preds.append(fit.forecast(time_series.values[-fit.k_ar:], steps=1)[0][0])
-    except Exception:
-        pass
-    # Prophet
-    try:
-        df = pd.DataFrame({'ds': np.arange(len(time_series)), 'y': time_series})
-        m = Prophet()
-        m.fit(df)
-        future = pd.DataFrame({'ds': [len(time_series)]})
-        forecast = m.predict(future)
-        preds.append(forecast['yhat'].values[0])
-    except Exception:
-        pass
-    # XGBoost
-    try:
-        X = np.arange(len(time_series)).reshape(-1,1)
-        y = np.array(time_series)
-        model = XGBRegressor()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # LightGBM
-    try:
-        model = LGBMRegressor()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # CatBoost
-    try:
-        model = CatBoostRegressor(verbose=0)
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # Random Forest
-    try:
-        model = RandomForestRegressor()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # Gradient Boosting
-    try:
-        model = GradientBoostingRegressor()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # Extra Trees
-    try:
-        model = ExtraTreesRegressor()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # Histogram Gradient Boosting
-    try:
-        model = HistGradientBoostingRegressor()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # SVR
-    try:
-        model = SVR()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # Ridge
-    try:
-        model = Ridge()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # Lasso
-    try:
-        model = Lasso()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # Bayesian Ridge
-    try:
-        model = BayesianRidge()
-        model.fit(X, y)
-        preds.append(model.predict([[len(time_series)]])[0])
-    except Exception:
-        pass
-    # LSTM
-    try:
-        scaler = MinMaxScaler()
-        y_scaled = scaler.fit_transform(y.reshape(-1,1))
-        X_dl = np.array([y_scaled[i-5:i] for i in range(5, len(y_scaled))])
-        y_dl = y_scaled[5:]
-        model = Sequential([LSTM(10, input_shape=(5,1)), Dense(1)])
-        model.compile(optimizer='adam', loss='mse')
-        model.fit(X_dl, y_dl, epochs=10, verbose=0)
-        pred = model.predict(y_scaled[-5:].reshape(1,5,1))
-        preds.append(scaler.inverse_transform(pred)[0][0])
-    except Exception:
-        pass
-    # GRU
-    try:
-        model = Sequential([GRU(10, input_shape=(5,1)), Dense(1)])
-        model.compile(optimizer='adam', loss='mse')
-        model.fit(X_dl, y_dl, epochs=10, verbose=0)
-        pred = model.predict(y_scaled[-5:].reshape(1,5,1))
-        preds.append(scaler.inverse_transform(pred)[0][0])
-    except Exception:
-        pass
-    # CNN
-    try:
-        model = Sequential([Conv1D(16, 2, activation='relu', input_shape=(5,1)), Flatten(), Dense(1)])
-        model.compile(optimizer='adam', loss='mse')
-        model.fit(X_dl, y_dl, epochs=10, verbose=0)
-        pred = model.predict(y_scaled[-5:].reshape(1,5,1))
-        preds.append(scaler.inverse_transform(pred)[0][0])
-    except Exception:
-        pass
-    # Average all model predictions
-    return np.mean(preds) if preds else np.nan
-
 def main():
     cfg = load_config()
-    phys = Physiology(**{k: float(v) for k, v in cfg['physiology'].items()})
-    cmpd = Compound(**{k: v if k == 'name' else float(v) for k, v in cfg['compound'].items()})
-    qsp_tuple = tuple(float(v) for v in cfg['qsp'].values())
-    dosing_events = [DosingEvent(**d) for d in cfg['dosing']]
+    setup = model_from_config(cfg)
     t_end = 24.0
     dt = 0.1
+    cache_cfg = cfg.get('cache', {})
+    cache = SimulationCache(maxsize=int(cache_cfg.get('memory_items', 128)),
+                            directory=cache_cfg.get('directory'),
+                            max_disk_bytes=int(float(cache_cfg.get('max_disk_mb', 512))*2**20))
 
-    pbpk_pred = pbpk_predict(phys, cmpd, qsp_tuple, dosing_events, t_end, dt)
-    # For demonstration, use simulated PBPK output as time series
-    sim = PBPKQSPSimulator(phys, cmpd, qsp_params=qsp_tuple)
-    df = sim.simulate(dosing_events, t_end=t_end, dt=dt)
+    # For demonstration, use simulated PBPK output as time series; its exact
+    # Blood AUC is the PBPK prediction, so the model is integrated only once
+    sim = setup.simulator()
+    df, auc = cache.simulate(sim, setup.events, t_end=t_end, dt=dt, return_auc=True)
+    pbpk_pred = auc['Blood']  # Example: use AUC as the prediction
     blood_ts = df['Blood'].values
-    ensemble_pred = ensemble_predict(blood_ts)
-    final_pred = 0.95 * pbpk_pred + 0.05 * ensemble_pred
+    ens_cfg = cfg.get('ensemble', {})
+    mc_cfg = ens_cfg.get('model_cache', {})
+    configure_model_cache(directory=mc_cfg.get('directory'),
+                          max_disk_bytes=int(float(mc_cfg.get('max_disk_mb', 256))*2**20),
+                          maxsize=int(mc_cfg.get('memory_items', 32)))
+    configure_keras(**ens_cfg.get('keras', {}))
+    # Stacking weights from a rolling-origin backtest replace the plain member mean
+    weights = None
+    bt_cfg = ens_cfg.get('backtest', {})
+    if bt_cfg.get('enabled'):
+        bt = Backtester(models=ens_cfg.get('models'), min_train=int(bt_cfg.get('min_train', 48)),
+                        step=int(bt_cfg.get('step', 12)), n_folds=bt_cfg.get('n_folds'),
+                        method=bt_cfg.get('method', 'nnls'), parallel=ens_cfg.get('parallel', False),
+                        timeout=ens_cfg.get('timeout')).run(blood_ts)
+        weights = bt.weight_dict()
+        print(bt.report().to_string(index=False))
+    ensemble_pred = ensemble_predict(blood_ts, models=ens_cfg.get('models'),
+                                     parallel=ens_cfg.get('parallel', False),
+                                     timeout=ens_cfg.get('timeout'), deadline=ens_cfg.get('deadline'),
+                                     weights=weights)
+    blend = float(ens_cfg.get('blend', 0.05))
+    final_pred = (1 - blend) * pbpk_pred + blend * ensemble_pred
     print(f"Final Prediction: {final_pred}")
+    # Joint next-step forecast of every PBPK/QSP channel in one fit per model
+    mv_cfg = ens_cfg.get('multivariate', {})
+    if mv_cfg.get('enabled'):
+        print(multivariate_predict(df, models=mv_cfg.get('models')).to_string())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,121 @@
+"""Rolling-origin backtests of the ensemble members and stacking weights from their errors"""
+import numpy as np
+import pandas as pd
+from scipy.optimize import nnls
+from cache import array_digest
+from forecasters import REGISTRY, ensemble_predict
+
+def rolling_origins(n, min_train=48, step=12, n_folds=None):
+    """Forecast origins (training lengths) min_train, min_train + step, ... below n.
+
+    Origins are anchored at min_train rather than at the end of the series, so
+    when new observations arrive the earlier folds stay the same and come
+    straight from the fold cache. n_folds keeps only the most recent ones.
+    """
+    origins = list(range(min_train, n, step))
+    return origins[-n_folds:] if n_folds else origins
+
+def stacking_weights(preds, truth, method='nnls'):
+    """Non-negative weights summing to one from out-of-sample predictions.
+
+    preds is (n_folds, n_models). 'nnls' fits the stacked combination directly;
+    'inverse_mse' weights each model by 1/MSE. Models with a failed fold get
+    weight zero.
+    """
+    preds = np.asarray(preds, dtype=float)
+    truth = np.asarray(truth, dtype=float)
+    usable = np.isfinite(preds).all(axis=0)
+    w = np.zeros(preds.shape[1])
+    if not usable.any():
+        return w
+    if method == 'nnls':
+        w[usable], _ = nnls(preds[:, usable], truth)
+    elif method == 'inverse_mse':
+        mse = ((preds[:, usable] - truth[:, None])**2).mean(axis=0)
+        w[usable] = 1.0/np.maximum(mse, 1e-300)
+    else:
+        raise ValueError(f"Unknown stacking method {method!r}")
+    if w.sum() <= 0:
+        w[usable] = 1.0
+    return w/w.sum()
+
+class Backtester:
+    """Evaluate forecasters over rolling origins and learn their ensemble weights.
+
+    Each fold runs the selected members on series[:origin] through
+    ensemble_predict (so parallel pools, timeouts and the shared lag features
+    apply) and scores them against series[origin]. Fold results are cached by
+    model and training-prefix digest, so rerunning after new data arrives only
+    fits the new folds.
+    """
+    def __init__(self, models=None, min_train=48, step=12, n_folds=None, method='nnls',
+                 parallel=True, timeout=None, max_workers=None):
+        self.models = list(models or REGISTRY)
+        self.min_train = min_train
+        self.step = step
+        self.n_folds = n_folds
+        self.method = method
+        self.parallel = parallel
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.folds = {}
+
+    def _fold(self, history):
+        key = array_digest(history)
+        todo = [m for m in self.models if (m, key) not in self.folds]
+        if todo:
+            _, report = ensemble_predict(history, models=todo, parallel=self.parallel,
+                                         timeout=self.timeout, max_workers=self.max_workers,
+                                         return_report=True)
+            for r in report:
+                self.folds[r['model'], key] = (r['value'], r['wall_time'], r['status'])
+        return [self.folds[m, key] for m in self.models]
+
+    def run(self, series):
+        """Fold-by-model predictions, truths and costs over every rolling origin"""
+        y = np.asarray(series, dtype=float)
+        origins = rolling_origins(len(y), self.min_train, self.step, self.n_folds)
+        if not origins:
+            raise ValueError(f"Series of length {len(y)} leaves no origin after min_train={self.min_train}")
+        rows = [self._fold(y[:o]) for o in origins]
+        self.origins = np.array(origins)
+        self.preds = np.array([[v if st == 'ok' else np.nan for v, _, st in r] for r in rows])
+        self.costs = np.array([[wt for _, wt, _ in r] for r in rows])
+        self.truth = y[self.origins]
+        self.weights = stacking_weights(self.preds, self.truth, self.method)
+        return self
+
+    def weight_dict(self):
+        return dict(zip(self.models, self.weights))
+
+    def report(self):
+        """Per-model out-of-sample accuracy against fit+predict cost, best first"""
+        err = self.preds - self.truth[:, None]
+        scale = np.abs(self.truth).mean() or 1.0
+        with np.errstate(invalid='ignore'):
+            res = pd.DataFrame({
+                'model': self.models,
+                'n_ok': np.isfinite(self.preds).sum(axis=0),
+                'mae': np.nanmean(np.abs(err), axis=0),
+                'rmse': np.sqrt(np.nanmean(err**2, axis=0)),
+                'rel_mae': np.nanmean(np.abs(err), axis=0)/scale,
+                'mean_wall_time': self.costs.mean(axis=0),
+                'weight': self.weights,
+            })
+        return res.sort_values(['rmse', 'mean_wall_time']).reset_index(drop=True)
+
+def main():
+    from app import load_config, model_from_config
+    cfg = load_config()
+    setup = model_from_config(cfg)
+    blood = setup.simulator().simulate(setup.events, t_end=24.0, dt=0.1)['Blood'].values
+    ens_cfg = cfg.get('ensemble', {})
+    bt_cfg = ens_cfg.get('backtest', {})
+    bt = Backtester(models=ens_cfg.get('models'), min_train=int(bt_cfg.get('min_train', 48)),
+                    step=int(bt_cfg.get('step', 12)), n_folds=bt_cfg.get('n_folds'),
+                    method=bt_cfg.get('method', 'nnls'), parallel=ens_cfg.get('parallel', False),
+                    timeout=ens_cfg.get('timeout'))
+    print(bt.run(blood).report().to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""Regimen update cost: full re-simulation from t=0 vs continue_from the last checkpoint"""
+import numpy as np
+from app import DosingEvent, model_from_config
+from bench_timeline import best_of
+
+def history(days, interval=12.0):
+    """Oral doses every interval hours over the patient's history"""
+    return [DosingEvent('oral', 100.0, k*interval) for k in range(int(days*24/interval))]
+
+def main(days=(2, 7, 30, 90), window=48.0, dt=0.5, method='RK45'):
+    sim = model_from_config().simulator()
+    print(f"{'days':>5s} {'re-simulate':>12s} {'continue':>10s} {'speedup':>8s} {'max rel err':>12s}")
+    for d in days:
+        t_now = 24.0*d
+        events = history(d)
+        sim.simulate(events, t_end=t_now, dt=dt, method=method, checkpoints=[t_now])
+        cp = sim.latest_checkpoint(t_now)
+        new = [DosingEvent('iv_infusion', 50.0, t_now, 1.0), DosingEvent('oral', 100.0, t_now + 12.0)]
+        t_end = t_now + window
+        full = best_of(lambda: sim.simulate(events + new, t_end=t_end, dt=dt, method=method), repeats=1)
+        inc = best_of(lambda: sim.continue_from(cp, new, t_end=t_end, dt=dt, method=method))
+        ref = sim.simulate(events + new, t_end=t_end, dt=dt, method=method)
+        tail = ref[ref['Time_h'] >= cp.time - 1e-9].to_numpy()
+        got = sim.continue_from(cp, new, t_end=t_end, dt=dt, method=method).to_numpy()
+        err = (np.abs(got - tail).max(axis=0)/np.maximum(np.abs(tail).max(axis=0), 1e-12)).max()
+        print(f"{d:5d} {full:11.3f}s {inc:9.3f}s {full/inc:7.1f}x {err:12.2e}")
+
+if __name__ == "__main__":
+    main()
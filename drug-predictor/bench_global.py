@@ -0,0 +1,41 @@
+"""Series per second: one global boosted model vs per-series local models on a PBPK population panel"""
+import time
+import numpy as np
+from app import load_config, model_from_config
+from population import sample_physiology, simulate_population
+from forecasters import global_predict, local_predict
+
+def population_panel(n_subjects, seed=0):
+    """Every compartment of every simulated subject as one row"""
+    cfg = load_config()
+    setup = model_from_config(cfg)
+    pop_cfg = cfg.get('population', {})
+    phys = sample_physiology(n_subjects, pop_cfg.get('distributions', {}), base=setup.phys, seed=seed)
+    out = simulate_population(phys, setup.cmpd, setup.events, method='expm', return_trajectories=True,
+                              tissues=setup.tissues)
+    Y = out['trajectories'][:, :, 1:]  # Blood and every tissue
+    return Y.transpose(0, 2, 1).reshape(-1, Y.shape[1])
+
+def main(n_subjects=250, n_local=50):
+    panel = population_panel(n_subjects)
+    history, truth = panel[:, :-1], panel[:, -1]
+    scale = np.abs(truth).mean()
+    for backend in ('lightgbm', 'xgboost'):
+        try:
+            t0 = time.perf_counter()
+            pred = global_predict(history, backend=backend)
+            secs = time.perf_counter() - t0
+        except ImportError as e:
+            print(f"global {backend:8s} unavailable: {e}")
+            continue
+        mae = np.abs(pred - truth).mean()/scale
+        print(f"global {backend:8s} {len(panel):6d} series  {len(panel)/secs:9.1f} series/s  rel MAE {mae:.3g}")
+    sub = slice(0, n_local)
+    t0 = time.perf_counter()
+    pred = local_predict(history[sub], models=('lightgbm',))
+    secs = time.perf_counter() - t0
+    mae = np.abs(pred - truth[sub]).mean()/scale
+    print(f"local  lightgbm {n_local:6d} series  {n_local/secs:9.1f} series/s  rel MAE {mae:.3g}")
+
+if __name__ == "__main__":
+    main()
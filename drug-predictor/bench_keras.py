@@ -0,0 +1,48 @@
+"""Per-call latency of the deep members: rebuild-every-call vs the warm pool vs cached weights"""
+import time
+import numpy as np
+from forecasters import REGISTRY, lag_features, configure_keras, configure_model_cache
+
+DEEP = ('lstm', 'gru', 'cnn')
+
+def legacy_predict(build, time_series):
+    """Reference copy of the original path: build, compile, train and Keras predict per call"""
+    feats = lag_features(time_series)
+    y = np.asarray(time_series, dtype=float)
+    lo, span = y.min(), np.ptp(y) or 1.0
+    X = ((feats.lags - lo)/span)[:, :, None]
+    model = build()
+    model.compile(optimizer='adam', loss='mse')
+    model.fit(X[:-1], (feats.target - lo)/span, epochs=10, verbose=0)
+    return model.predict(X[-1:], verbose=0)[0][0]*span + lo
+
+def latency(fn, series):
+    times = []
+    for y in series:
+        t0 = time.perf_counter()
+        fn(y)
+        times.append(time.perf_counter() - t0)
+    return np.median(times)
+
+def main(n_calls=5, n=240, threads=2):
+    try:
+        import tensorflow  # noqa: F401
+    except ImportError:
+        print("tensorflow is not installed; nothing to benchmark")
+        return
+    configure_keras(intra_op_threads=threads, inter_op_threads=1)
+    rng = np.random.default_rng(0)
+    series = [np.exp(-np.linspace(0, 5, n))*10 + 0.1*rng.standard_normal(n) for _ in range(n_calls)]
+    for name in DEEP:
+        build = REGISTRY[name].predict.build
+        cold = latency(lambda y: legacy_predict(build, y), series)
+        configure_model_cache(directory=None)
+        REGISTRY[name].predict(series[0])  # first call builds and traces the pooled model
+        warm = latency(REGISTRY[name].predict, series[1:] + [series[0]*1.01])
+        cached = latency(REGISTRY[name].predict, series)
+        print(f"{name:5s} rebuild: {cold*1e3:8.1f} ms  warm fit: {warm*1e3:8.1f} ms  "
+              f"cached inference: {cached*1e3:7.2f} ms")
+    configure_model_cache(maxsize=0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Accuracy vs cost of every forecaster on synthetic PBPK Blood curves, and the Pareto ensemble"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import yaml
+from app import DosingEvent, load_config, model_from_config
+from population import sample_physiology, simulate_population
+from forecasters import REGISTRY
+
+LENGTHS = (240, 2400, 24000)
+
+def make_corpus(lengths=LENGTHS, n_curves=3, dt=0.1, interval=12.0, noise=0.01, seed=0):
+    """Blood curves of sampled subjects under repeated oral dosing, one (n_curves, length) array per length"""
+    cfg = load_config()
+    setup = model_from_config(cfg)
+    base, cmpd = setup.phys, setup.cmpd
+    dists = cfg.get('population', {}).get('distributions', {})
+    rng = np.random.default_rng(seed)
+    corpus = {}
+    for n in lengths:
+        t_end = (n - 1)*dt
+        events = [DosingEvent('oral', 100.0, k*interval) for k in range(int(np.ceil(t_end/interval)))]
+        phys = sample_physiology(n_curves, dists, base=base, seed=seed + n)
+        out = simulate_population(phys, cmpd, events, t_end=t_end, dt=dt, method='expm',
+                                  return_trajectories=True, tissues=setup.tissues)
+        blood = out['trajectories'][:, :n, out['columns'].index('Blood')]
+        corpus[n] = blood*(1 + noise*rng.standard_normal(blood.shape))
+    return corpus
+
+# Runs one model on one corpus length in a fresh interpreter so peak RSS is its own
+PROBE = """
+import json, resource, sys, time
+import numpy as np
+import forecasters
+name, path, n = sys.argv[1], sys.argv[2], sys.argv[3]
+curves = np.load(path)[n]
+forecasters.import_backends([name])
+forecasters.configure_model_cache(directory=None)
+rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+member = forecasters.REGISTRY[name]
+fit, pred, err = [], [], []
+for y in curves:
+    t0 = time.perf_counter()
+    value = member.predict(y[:-1])
+    t1 = time.perf_counter()
+    if member.features:
+        member.predict(y[:-1])  # fitted model comes from the cache: inference only
+    t2 = time.perf_counter()
+    fit.append(t1 - t0 - (t2 - t1) if member.features else t1 - t0)
+    pred.append(t2 - t1 if member.features else float('nan'))
+    err.append(abs(value - y[-1])/np.abs(y).mean())
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss0
+print(json.dumps({'fit_time': float(np.mean(fit)), 'predict_time': float(np.mean(pred)),
+                  'peak_mem_mb': rss*(1024 if sys.platform != 'darwin' else 1)/2**20,
+                  'rel_error': float(np.mean(err))}))
+"""
+
+def run_probe(name, path, n, timeout):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.abspath(__file__)),
+                                                       os.environ.get('PYTHONPATH', '')]))
+    try:
+        out = subprocess.run([sys.executable, '-c', PROBE, name, path, str(n)], capture_output=True,
+                             text=True, timeout=timeout, env=env)
+    except subprocess.TimeoutExpired:
+        return {'status': 'timeout'}
+    if out.returncode != 0:
+        return {'status': 'error', 'error': out.stderr.strip().splitlines()[-1] if out.stderr else ''}
+    return {'status': 'ok', **json.loads(out.stdout.strip().splitlines()[-1])}
+
+def pareto_front(summary, cost='cost', error='rel_error'):
+    """Models no other model beats on both cost and error"""
+    s = summary.dropna(subset=[cost, error])
+    keep = [m for m, r in s.iterrows()
+            if not ((s[cost] <= r[cost]) & (s[error] <= r[error]) &
+                    ((s[cost] < r[cost]) | (s[error] < r[error]))).any()]
+    return s.loc[keep].sort_values(cost)
+
+def run(lengths=LENGTHS, n_curves=3, models=None, timeout=600):
+    """One row per (model, length) with fit/predict time, peak memory and relative error"""
+    models = models or list(REGISTRY)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'corpus.npz')
+        np.savez(path, **{str(n): c for n, c in make_corpus(lengths, n_curves).items()})
+        for n in lengths:
+            for name in models:
+                res = run_probe(name, path, n, timeout)
+                rows.append({'model': name, 'length': n, **res})
+                print(f"{name:24s} n={n:6d} {res['status']:7s} "
+                      + (f"fit {res['fit_time']:8.3f}s  rel err {res['rel_error']:.3g}"
+                         if res['status'] == 'ok' else res.get('error', '')), flush=True)
+    return pd.DataFrame(rows)
+
+def summarize(results):
+    """Per-model error and cost over all lengths; models failing at any length are left out.
+
+    predict_time is only known for members whose fitted model is cached; for the
+    others fit_time covers the whole call.
+    """
+    ok = results[results['status'] == 'ok']
+    failed = set(results.loc[results['status'] != 'ok', 'model'])
+    s = ok.groupby('model').agg(rel_error=('rel_error', 'mean'), fit_time=('fit_time', 'sum'),
+                                predict_time=('predict_time', lambda v: v.sum(min_count=1)), peak_mem_mb=('peak_mem_mb', 'max'))
+    s['cost'] = s['fit_time'] + s['predict_time'].fillna(0.0)
+    return s.drop(index=[m for m in failed if m in s.index])
+
+def main(out='pareto_ensemble.yaml', **kw):
+    results = run(**kw)
+    summary = summarize(results)
+    front = pareto_front(summary)
+    print(summary.sort_values('cost').to_string())
+    print("\nPareto-optimal members:\n" + front.to_string())
+    with open(out, 'w') as f:
+        yaml.safe_dump({'ensemble': {'models': list(front.index)}}, f, sort_keys=False)
+    print(f"\nWrote {out}")
+
+if __name__ == "__main__":
+    main()
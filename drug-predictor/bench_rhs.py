@@ -0,0 +1,74 @@
+"""RHS evaluations per second: legacy per-compartment loop vs matrix form"""
+import time
+import numpy as np
+from app import PBPKQSPSimulator, Tissue, default_tissues, model_from_config
+
+def legacy_odes(sim, t, y, events):
+    """Reference copy of the original loop-based RHS"""
+    inj = np.zeros(sim.n_pk)
+    for ev in events:
+        if ev.type=='iv_bolus' and abs(t-ev.time)<sim.dt/2:
+            inj[1] += ev.amount/sim.dt
+        elif ev.type=='iv_infusion' and ev.time <= t < ev.time+ev.duration:
+            inj[1] += ev.amount/ev.duration
+        elif ev.type=='oral' and abs(t-ev.time)<sim.dt/2:
+            inj[0] += ev.amount/sim.dt
+    Agut, Ab, Aliv, Amusc, Afat = y[:5]
+    dAgut = -sim.cmpd.k_abs*Agut + inj[0]
+    Cb = Ab/sim.vols[1]
+    dAb = sim.cmpd.k_abs*Agut + inj[1]
+    dAliv = dAmusc = dAfat = 0.0
+    for idx, (vol, flow, kp, cl) in enumerate(zip(sim.vols, sim.flows, sim.kps, sim.clint)):
+        if idx<2: continue
+        Ci = y[idx]/vol
+        flux = flow*(Cb - Ci/kp)
+        dAb   -= flux
+        if idx==2: dAliv = flux - cl*Ci
+        elif idx==3: dAmusc = flux
+        elif idx==4: dAfat  = flux
+    dPK = [dAgut, dAb, dAliv, dAmusc, dAfat]
+    if sim.qsp:
+        kon, koff, Rtot, kprod, kdeg = sim.qsp
+        Rf, Rc, M = y[5:8]
+        bind = kon*Cb*Rf - koff*Rc
+        return dPK + [-bind, bind, kprod*Rc - kdeg*M]
+    return dPK
+
+def evals_per_second(fn, y, n=20000):
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(0.01*i, y)
+    return n/(time.perf_counter() - t0)
+
+def main():
+    setup = model_from_config()
+    phys, cmpd, qsp_tuple, events = setup.phys, setup.cmpd, setup.qsp, setup.events
+    for label, qsp in (('PK', None), ('PK+QSP', qsp_tuple)):
+        sim = PBPKQSPSimulator(phys, cmpd, qsp_params=qsp)
+        sim.dt = 0.1
+        y = np.random.default_rng(0).random(sim.n_pk + sim.n_qsp)
+        before = evals_per_second(lambda t, y: legacy_odes(sim, t, y, events), y)
+        rate = np.zeros(sim.n_pk)
+        after = evals_per_second(lambda t, y: sim.odes(t, y, rate), y)
+        print(f"{label:7s} legacy: {before:10.0f} evals/s  matrix: {after:10.0f} evals/s  speedup: {after/before:.2f}x")
+        for method in ('RK45', 'BDF', 'Radau', 'LSODA', 'expm', 'auto'):
+            t0 = time.perf_counter()
+            sim.simulate(events, method=method)
+            chosen = f"{method}->{sim.method}" if method == 'auto' else method
+            print(f"{label:7s} simulate[{chosen}]: {sim.nfev} RHS evals in {time.perf_counter()-t0:.3f}s")
+    # Whole-body style models: the base tissues plus generated ones, same fast path
+    rng = np.random.default_rng(1)
+    for n_extra in (0, 12, 30):
+        tissues = default_tissues(phys, cmpd) + [
+            Tissue(f"T{k}", rng.uniform(0.2, 5.0), rng.uniform(5.0, 80.0), rng.uniform(0.5, 20.0),
+                   rng.uniform(0.0, 2.0)) for k in range(n_extra)]
+        sim = PBPKQSPSimulator(phys, cmpd, qsp_params=qsp_tuple, tissues=tissues)
+        for method in ('LSODA', 'BDF', 'auto'):
+            t0 = time.perf_counter()
+            sim.simulate(events, method=method)
+            chosen = f"{method}->{sim.method}" if method == 'auto' else method
+            print(f"{sim.n_pk:3d} PK states simulate[{chosen}]: {sim.nfev} RHS evals in "
+                  f"{time.perf_counter()-t0:.3f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Cold-start import time and peak RSS for PBPK-only and full-ensemble modes"""
+import subprocess
+import sys
+
+MODES = {
+    'pbpk': "import app",
+    'ensemble': "import app, forecasters; forecasters.import_backends()",
+}
+
+PROBE = """
+import resource, sys, time
+t0 = time.perf_counter()
+{stmt}
+dt = time.perf_counter() - t0
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(dt, rss*1024 if sys.platform != 'darwin' else rss)
+"""
+
+def measure(stmt):
+    """Run stmt in a fresh interpreter so nothing is already imported"""
+    out = subprocess.run([sys.executable, '-c', PROBE.format(stmt=stmt)], capture_output=True, text=True)
+    if out.returncode:
+        # e.g. "ModuleNotFoundError: No module named 'prophet'" when a backend is missing
+        raise ImportError(out.stderr.strip().splitlines()[-1])
+    seconds, rss = out.stdout.split()[-2:]
+    return float(seconds), int(float(rss))
+
+def main(repeats=3):
+    for mode, stmt in MODES.items():
+        try:
+            runs = [measure(stmt) for _ in range(repeats)]
+        except ImportError as e:
+            print(f"{mode:9s} unavailable: {e}")
+            continue
+        best = min(s for s, _ in runs)
+        peak = max(r for _, r in runs)
+        print(f"{mode:9s} import: {best:7.3f}s  peak RSS: {peak/2**20:8.1f} MiB")
+
+if __name__ == "__main__":
+    main()
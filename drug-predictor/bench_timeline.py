@@ -0,0 +1,59 @@
+"""Dose-schedule compilation cost from 1 to 10,000 doses: per-segment event scan vs DoseTimeline"""
+import time
+import numpy as np
+from app import DosingEvent, DoseTimeline, GUT, BLOOD, model_from_config
+
+def legacy_dose_segments(events, t_start, t_end, n_pk):
+    """Reference copy of the original scan: every segment walks the whole event list"""
+    bounds = {t_start, t_end}
+    for ev in events:
+        bounds.add(ev.time)
+        if ev.type == 'iv_infusion' and ev.duration > 0:
+            bounds.add(ev.time + ev.duration)
+    bounds = sorted(b for b in bounds if t_start <= b <= t_end)
+    segs = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        jump = np.zeros(n_pk)
+        rate = np.zeros(n_pk)
+        for ev in events:
+            if ev.type == 'iv_infusion' and ev.duration > 0:
+                if ev.time <= a < ev.time + ev.duration:
+                    rate[BLOOD] += ev.amount/ev.duration
+            elif ev.time == a:
+                jump[GUT if ev.type == 'oral' else BLOOD] += ev.amount
+        segs.append((a, b, jump, rate))
+    return segs
+
+def regimen(n_doses, interval=12.0):
+    """Alternating oral doses and 1 h infusions every interval hours"""
+    return [DosingEvent('oral', 100.0, k*interval) if k % 2 else
+            DosingEvent('iv_infusion', 50.0, k*interval, 1.0) for k in range(n_doses)]
+
+def best_of(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+def main(sizes=(1, 10, 100, 1000, 10000), legacy_max=1000, dt=1.0):
+    sim = model_from_config().simulator(qsp=False)
+    print(f"{'doses':>6s} {'legacy scan':>12s} {'timeline':>10s} {'expm simulate':>14s}")
+    for n in sizes:
+        events = regimen(n)
+        t_end = 12.0*n + 24.0
+        new = best_of(lambda: DoseTimeline(events).segments(0.0, t_end, sim.n_pk))
+        if n <= legacy_max:
+            old = best_of(lambda: legacy_dose_segments(events, 0.0, t_end, sim.n_pk))
+            ref = legacy_dose_segments(events, 0.0, t_end, sim.n_pk)
+            got = DoseTimeline(events).segments(0.0, t_end, sim.n_pk)
+            assert all(np.allclose(r[2], g[2]) and np.allclose(r[3], g[3]) for r, g in zip(ref, got))
+            old_s = f"{old*1e3:10.2f}ms"
+        else:
+            old_s = f"{'(skipped)':>12s}"
+        full = best_of(lambda: sim.simulate(events, t_end=t_end, dt=dt, method='expm'), repeats=1)
+        print(f"{n:6d} {old_s} {new*1e3:8.2f}ms {full:13.3f}s")
+
+if __name__ == "__main__":
+    main()
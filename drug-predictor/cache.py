@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import fields, is_dataclass
+import numpy as np
+
+CACHE_VERSION = 2
+
+def _canonical(o):
+    """Reduce configs to plain JSON types; ints become floats so 50 and 50.0 hash alike"""
+    if is_dataclass(o):
+        return {'__type__': type(o).__name__, **{f.name: _canonical(getattr(o, f.name)) for f in fields(o)}}
+    if isinstance(o, dict):
+        return {str(k): _canonical(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [_canonical(v) for v in o]
+    if isinstance(o, np.ndarray):
+        return [_canonical(v) for v in o.tolist()]
+    if isinstance(o, np.generic):
+        o = o.item()
+    if isinstance(o, bool) or o is None or isinstance(o, str):
+        return o
+    if isinstance(o, (int, float)):
+        return float(o)
+    raise TypeError(f"Cannot hash object of type {type(o).__name__}")
+
+def stable_hash(*parts):
+    """sha256 of a canonical JSON encoding, stable across processes and sessions"""
+    payload = json.dumps(_canonical(parts), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def array_digest(a):
+    """sha256 of an array's float64 bytes; cheaper than stable_hash for long series"""
+    return hashlib.sha256(np.ascontiguousarray(a, dtype=np.float64).tobytes()).hexdigest()
+
+class DiskLRU:
+    """Directory of key-named files evicted least-recently-used first once over max_bytes"""
+    def __init__(self, directory, max_bytes=512*2**20, suffix='.npz'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def put(self, key, write):
+        """write(path) stores the entry; written to a temp name and renamed into place"""
+        path = self.path(key)
+        # Keep the extension last: some writers pick their format from it
+        tmp = os.path.join(self.directory, '.tmp-' + os.path.basename(path))
+        write(tmp)
+        os.replace(tmp, path)
+        self.evict()
+        return path
+
+    def _entries(self):
+        return [e for e in os.scandir(self.directory)
+                if e.is_file() and e.name.endswith(self.suffix) and not e.name.startswith('.tmp-')]
+
+    def size(self):
+        return sum(e.stat().st_size for e in self._entries())
+
+    def evict(self):
+        entries = self._entries()
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        total = sum(e.stat().st_size for e in entries)
+        for e in entries:
+            if total <= self.max_bytes:
+                break
+            total -= e.stat().st_size
+            os.remove(e.path)
+
+class SimulationCache:
+    """Two-tier (memory LRU + optional npz directory) cache in front of PBPKQSPSimulator.simulate"""
+    def __init__(self, maxsize=128, directory=None, max_disk_bytes=512*2**20):
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.disk = DiskLRU(directory, max_disk_bytes) if directory else None
+        self.hits = self.disk_hits = self.misses = 0
+
+    def key(self, sim, events, t_end, dt, **solver):
+        return stable_hash(CACHE_VERSION, type(sim).__name__, sim.phys, sim.cmpd, sim.qsp,
+                           getattr(sim, 'tissues', None), getattr(sim, 'binding', 'full'),
+                           list(events), t_end, dt, solver)
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def _lookup(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        path = self.disk.get(key) if self.disk else None
+        if path is not None:
+            with np.load(path) as f:
+                entry = (f['t'], f['Y'], list(f['columns']), f['auc'])
+            for a in (entry[0], entry[1], entry[3]):
+                a.flags.writeable = False
+            self._remember(key, entry)
+            self.disk_hits += 1
+            return entry
+        return None
+
+    def simulate(self, sim, events, t_end=24.0, dt=0.1, return_auc=False, **solver):
+        """Same result as sim.simulate(events, t_end, dt, return_auc=return_auc, **solver), computed at most once"""
+        if solver.get('checkpoints') is not None:
+            # A hit would return the frame without filling sim.checkpoints
+            raise ValueError("checkpoints are not cached; call sim.simulate(..., checkpoints=...) directly")
+        key = self.key(sim, events, t_end, dt, **solver)
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            t, Y = sim._integrate(events, t_end, dt, **solver)
+            auc = sim.pk_auc(events, t[-1])
+            t.flags.writeable = Y.flags.writeable = auc.flags.writeable = False
+            entry = (t, Y, sim.columns(), auc)
+            self._remember(key, entry)
+            if self.disk:
+                self.disk.put(key, lambda p: np.savez(p, t=t, Y=Y, columns=np.array(entry[2]), auc=auc))
+        t, Y, cols, auc = entry
+        return sim.frame(t.copy(), Y.copy(), auc if return_auc else None)
+
+    def summarize(self, sim, events, t_end=24.0, **solver):
+        """Memoised sim.simulate_summary; summaries are small so they live in memory only"""
+        key = self.key(sim, events, t_end, 'summary', **solver)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = sim.simulate_summary(events, t_end=t_end, **solver)
+            entry['final_state'].flags.writeable = False
+            self._remember(key, entry)
+        out = dict(self.memory[key])
+        out['final_state'] = out['final_state'].copy()
+        return out
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'memory_items': len(self.memory),
+                'disk_bytes': self.disk.size() if self.disk else 0}
+
+    def clear(self):
+        self.memory.clear()
+
+class ModelCache:
+    """Fitted forecaster cache: memory LRU of live models plus size-bounded native files.
+
+    Entries are keyed by the model, its hyperparameters and a digest of the
+    training series, so a repeated forecast on an unchanged series only pays
+    for inference. Each backend saves in its own format (see forecasters).
+    """
+    def __init__(self, directory=None, max_disk_bytes=256*2**20, maxsize=32):
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.disk = DiskLRU(directory, max_disk_bytes, suffix='') if directory else None
+        self.hits = self.disk_hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, name, params, series):
+        return stable_hash(CACHE_VERSION, name, params, array_digest(series))
+
+    def get_or_fit(self, key, fit, save=None, load=None, ext=''):
+        """Return the cached model for key, or fit() it and store it in both tiers"""
+        with self._lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+        fname = f"{key}.{ext}" if ext else key
+        path = self.disk.get(fname) if self.disk and load else None
+        if path is not None:
+            model = load(path)
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            model = fit()
+            with self._lock:
+                self.misses += 1
+            if self.disk and save:
+                self.disk.put(fname, lambda p: save(model, p))
+        with self._lock:
+            self.memory[key] = model
+            while len(self.memory) > self.maxsize:
+                self.memory.popitem(last=False)
+        return model
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'memory_items': len(self.memory),
+                'disk_bytes': self.disk.size() if self.disk else 0}
@@ -0,0 +1,868 @@
+import importlib
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from cache import ModelCache
+
+@dataclass
+class Forecaster:
+    """A named ensemble member; its backend is only imported when it first runs.
+
+    pool says where it runs in a parallel ensemble: 'process' for GIL-bound
+    pure-Python fits, 'thread' for backends that release the GIL. Members with
+    features=True take the shared LagFeatures built once per ensemble call.
+    """
+    name: str
+    predict: callable
+    backends: tuple = ()
+    pool: str = 'thread'
+    features: bool = False
+
+REGISTRY = {}
+
+def register(name, *backends, pool='thread', features=False):
+    def deco(fn):
+        REGISTRY[name] = Forecaster(name, fn, backends, pool, features)
+        return fn
+    return deco
+
+def import_backends(names=None):
+    """Import the backends of the given forecasters up front, e.g. to warm a worker"""
+    for name in names or list(REGISTRY):
+        for mod in REGISTRY[name].backends:
+            importlib.import_module(mod)
+
+def _steps(forecast, horizon):
+    """Members return a scalar next step, or a length-horizon array when horizon is given"""
+    forecast = np.asarray(forecast, dtype=float)
+    return forecast[0] if horizon is None else forecast[:horizon]
+
+# Statistical Models
+@register('holt_winters', 'statsmodels.tsa.holtwinters', pool='process')
+def holt_winters(time_series, horizon=None):
+    from statsmodels.tsa.holtwinters import ExponentialSmoothing
+    fit = ExponentialSmoothing(time_series).fit()
+    return _steps(fit.forecast(horizon or 1), horizon)
+
+@register('arima', 'statsmodels.tsa.arima.model', pool='process')
+def arima(time_series, horizon=None):
+    from statsmodels.tsa.arima.model import ARIMA
+    fit = ARIMA(time_series, order=(1,1,1)).fit()
+    return _steps(fit.forecast(horizon or 1), horizon)
+
+@register('sarima', 'statsmodels.tsa.statespace.sarimax', pool='process')
+def sarima(time_series, horizon=None):
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+    fit = SARIMAX(time_series, order=(1,1,1), seasonal_order=(1,1,1,12)).fit(disp=False)
+    return _steps(fit.forecast(horizon or 1), horizon)
+
+@register('var', 'statsmodels.tsa.vector_ar.var_model', pool='process')
+def var(time_series, horizon=None):
+    # VAR (requires multivariate)
+    if not (isinstance(time_series, pd.DataFrame) and time_series.shape[1] > 1):
+        raise ValueError("VAR needs a multivariate DataFrame")
+    from statsmodels.tsa.vector_ar.var_model import VAR
+    fit = VAR(time_series).fit()
+    return _steps(fit.forecast(time_series.values[-fit.k_ar:], steps=horizon or 1)[:, 0], horizon)
+
+@register('prophet', 'prophet', pool='process')
+def prophet(time_series, horizon=None):
+    from prophet import Prophet
+    df = pd.DataFrame({'ds': np.arange(len(time_series)), 'y': time_series})
+    m = Prophet()
+    m.fit(df)
+    n = len(time_series)
+    forecast = m.predict(pd.DataFrame({'ds': np.arange(n, n + (horizon or 1))}))
+    return _steps(forecast['yhat'].values, horizon)
+
+class OnlineStatForecaster:
+    """Keeps the statistical members fitted across a streaming series.
+
+    update() extends the fitted ARIMA/SARIMA results with the new observations
+    via statsmodels' extend (only the new points are filtered, parameters held
+    fixed) and runs the Holt-Winters level recursion with the fitted smoothing
+    level. Every refit_every new observations all members are refit on the full
+    history, warm-started from their previous parameters.
+    """
+    MODELS = ('holt_winters', 'arima', 'sarima')
+
+    def __init__(self, models=MODELS, refit_every=100):
+        self.models = tuple(models)
+        self.refit_every = refit_every
+        self.history = []
+        self.results = {}
+        self.errors = {}
+        self.since_refit = 0
+        self.n_refits = 0
+
+    def _fit_one(self, name, y, start_params=None):
+        if name == 'holt_winters':
+            from statsmodels.tsa.holtwinters import ExponentialSmoothing
+            fit = ExponentialSmoothing(y).fit()
+            return {'alpha': fit.params['smoothing_level'], 'level': fit.level[-1]}
+        if name == 'arima':
+            from statsmodels.tsa.arima.model import ARIMA
+            return ARIMA(y, order=(1,1,1)).fit(start_params=start_params)
+        if name == 'sarima':
+            from statsmodels.tsa.statespace.sarimax import SARIMAX
+            return SARIMAX(y, order=(1,1,1), seasonal_order=(1,1,1,12)).fit(start_params=start_params, disp=False)
+        raise ValueError(f"No online variant for {name}")
+
+    def fit(self, time_series):
+        """Full fit on the whole history, warm-started when a previous fit exists"""
+        if time_series is not None:
+            self.history = list(np.asarray(time_series, dtype=float))
+        y = np.asarray(self.history)
+        for name in self.models:
+            prev = self.results.get(name)
+            start = getattr(prev, 'params', None)
+            try:
+                self.results[name] = self._fit_one(name, y, start_params=start)
+                self.errors.pop(name, None)
+            except Exception as e:
+                self.results.pop(name, None)
+                self.errors[name] = repr(e)
+        self.since_refit = 0
+        self.n_refits += 1
+        return self
+
+    def update(self, new_obs):
+        """Absorb new observations; cost is proportional to len(new_obs) between refits"""
+        new = np.atleast_1d(np.asarray(new_obs, dtype=float))
+        self.history.extend(new.tolist())
+        self.since_refit += len(new)
+        if not self.results or self.since_refit >= self.refit_every:
+            return self.fit(None)
+        for name, res in list(self.results.items()):
+            try:
+                if name == 'holt_winters':
+                    level, alpha = res['level'], res['alpha']
+                    for v in new:
+                        level = alpha*v + (1 - alpha)*level
+                    res['level'] = level
+                else:
+                    self.results[name] = res.extend(new)
+            except Exception as e:
+                self.results.pop(name)
+                self.errors[name] = repr(e)
+        return self
+
+    def forecast(self, horizon=None):
+        """Next-step (or horizon-step) forecast of every member that is currently fitted"""
+        out = {}
+        for name, res in self.results.items():
+            steps = np.full(horizon or 1, res['level']) if name == 'holt_winters' else res.forecast(horizon or 1)
+            out[name] = _steps(steps, horizon)
+        return out
+
+    def predict(self):
+        preds = list(self.forecast().values())
+        return np.mean(preds) if preds else np.nan
+
+# Shared feature pipeline
+N_LAGS = 5
+
+@dataclass
+class LagFeatures:
+    """Lag-window design matrix shared by the regressors and the deep models.
+
+    Row i describes the n_lags values before y[i + n_lags]: the lags (oldest
+    first), the window mean, std, min and max, and its first differences, all
+    in one contiguous float32 block. The last row is the window ending at the
+    final observation, i.e. the one to forecast from.
+    """
+    matrix: np.ndarray
+    target: np.ndarray
+    n_lags: int
+
+    @property
+    def X_train(self):
+        return self.matrix[:-1]
+
+    @property
+    def X_next(self):
+        return self.matrix[-1:]
+
+    @property
+    def lags(self):
+        return self.matrix[:, :self.n_lags]
+
+def _window_features(W, F):
+    """Fill F (n, 2*n_lags + 3) from lag windows W (n, n_lags)"""
+    n_lags = W.shape[1]
+    F[:, :n_lags] = W
+    W.mean(axis=1, out=F[:, n_lags])
+    W.std(axis=1, out=F[:, n_lags + 1])
+    W.min(axis=1, out=F[:, n_lags + 2])
+    W.max(axis=1, out=F[:, n_lags + 3])
+    np.subtract(W[:, 1:], W[:, :-1], out=F[:, n_lags + 4:])
+    return F
+
+def lag_features(time_series, n_lags=N_LAGS):
+    y = np.asarray(time_series, dtype=float)
+    if y.ndim != 1 or len(y) <= n_lags:
+        raise ValueError(f"Need a 1-D series longer than n_lags={n_lags}")
+    W = sliding_window_view(y.astype(np.float32), n_lags)
+    F = _window_features(W, np.empty((len(W), 2*n_lags + 3), dtype=np.float32))
+    return LagFeatures(F, y[n_lags:], n_lags)
+
+def _recursive(step, window, horizon, dtype=np.float32):
+    """Feed each one-step forecast back into the lag window; one single-row step per horizon"""
+    w = np.zeros(len(window) + horizon, dtype=np.float32)
+    w[:len(window)] = window
+    n_lags = len(window)
+    row = np.empty((1, 2*n_lags + 3), dtype=np.float32)
+    out = np.empty(horizon)
+    for h in range(horizon):
+        _window_features(w[None, h:h + n_lags], row)
+        out[h] = w[n_lags + h] = step(row.astype(dtype, copy=False))[0]
+    return out
+
+# Fitted-model cache (off unless configured)
+MODEL_CACHE = None
+
+def configure_model_cache(directory=None, max_disk_bytes=256*2**20, maxsize=32):
+    """Cache fitted tree and Keras members; directory=None keeps them in memory only"""
+    global MODEL_CACHE
+    MODEL_CACHE = ModelCache(directory, max_disk_bytes, maxsize) if maxsize else None
+    return MODEL_CACHE
+
+def _joblib_save(model, path):
+    import joblib
+    joblib.dump(model, path)
+
+def _joblib_load(path):
+    import joblib
+    return joblib.load(path)
+
+def _native_load(module, cls):
+    def load(path):
+        model = getattr(importlib.import_module(module), cls)()
+        model.load_model(path)
+        return model
+    return load
+
+def _lightgbm_load(path):
+    import lightgbm
+    return lightgbm.Booster(model_file=path)
+
+# Native formats where the library has one: (extension, save, load)
+SERIALIZERS = {
+    'xgboost': ('json', lambda m, p: m.save_model(p), _native_load('xgboost', 'XGBRegressor')),
+    'lightgbm': ('txt', lambda m, p: m.booster_.save_model(p), _lightgbm_load),
+    'catboost': ('cbm', lambda m, p: m.save_model(p), _native_load('catboost', 'CatBoostRegressor')),
+}
+
+def _cached_fit(name, params, time_series, fit, serializer=None):
+    if MODEL_CACHE is None:
+        return fit()
+    ext, save, load = serializer or ('joblib', _joblib_save, _joblib_load)
+    key = MODEL_CACHE.key(name, params, time_series)
+    return MODEL_CACHE.get_or_fit(key, fit, save, load, ext)
+
+# Tree-Based, Ensemble & Regression Models
+# Linear solvers lose the nearly collinear window statistics in float32
+FLOAT64_MODULES = ('sklearn.linear_model',)
+
+# Estimators that fit a 2-D target natively, with the params that make them do so
+MULTI_OUTPUT = {
+    'RandomForestRegressor': {}, 'ExtraTreesRegressor': {}, 'Ridge': {}, 'Lasso': {},
+    'XGBRegressor': {'multi_strategy': 'one_output_per_tree'},
+    'CatBoostRegressor': {'loss_function': 'MultiRMSE'},
+}
+# Linear single-output estimators: one fit per lead, applied as a single matrix product
+PER_LEAD = ('BayesianRidge',)
+# Rows of the stacked (window, lead) design for the remaining single-output estimators
+STACKED_ROWS = 4096
+
+def _lead_blocks(horizon):
+    """Leads 1..horizon as [1], [2, 3], [4..7], ... (0-based half-open column ranges).
+
+    A 2-D target cannot hold the missing future of the last rows, so each
+    block is fit on the rows its furthest lead has a target for; near leads
+    keep the most recent rows instead of all leads losing horizon - 1 of them.
+    """
+    edges = [0]
+    while edges[-1] < horizon:
+        edges.append(min(2*edges[-1] + 1, horizon))
+    return list(zip(edges[:-1], edges[1:]))
+
+def _lead_grid(horizon, n_rows):
+    """Leads to train a stacked model on: all of them, or a log-spaced subset within STACKED_ROWS"""
+    k = max(2, min(horizon, STACKED_ROWS//max(n_rows, 1)))
+    return np.unique(np.round(np.geomspace(1, horizon, k)).astype(int))
+
+class _LinearLeads:
+    """Per-lead linear models collapsed to coef (n_leads, n_features) and intercept"""
+    def __init__(self, models):
+        self.coef = np.stack([m.coef_ for m in models])
+        self.intercept = np.array([m.intercept_ for m in models])
+
+    def predict(self, X):
+        return X @ self.coef.T + self.intercept
+
+def _direct(module, cls, params, X, feats, horizon, time_series, key_params=None):
+    """Forecast leads 1..horizon from the last window with one predict call per fitted model"""
+    make = lambda **kw: getattr(importlib.import_module(module), cls)(**{**params, **kw})
+    key = {**(key_params or params), 'n_lags': feats.n_lags, 'horizon': horizon}
+    name = f"{module}.{cls}"
+    y, n = feats.target, len(feats.target)
+    if cls in MULTI_OUTPUT:
+        out = []
+        for a, b in _lead_blocks(horizon):
+            Y = sliding_window_view(y, b)[:, a:]
+            Y = Y[:, 0] if b - a == 1 else Y
+            def fit(Y=Y):
+                model = make(**(MULTI_OUTPUT[cls] if Y.ndim == 2 else {}))
+                model.fit(X[:len(Y)], Y)
+                return model
+            model = _cached_fit(name, {**key, 'leads': (a, b)}, time_series, fit, SERIALIZERS.get(module))
+            out.append(np.reshape(model.predict(X[-1:]), -1))
+        return np.concatenate(out)
+    if cls in PER_LEAD:
+        def fit():
+            return _LinearLeads([make().fit(X[:n - h], y[h:]) for h in range(horizon)])
+        return _cached_fit(name, key, time_series, fit).predict(X[-1:])[0]
+    # Stacked design: the lead (scaled to (0, 1]) is one more feature of a single model
+    leads = _lead_grid(horizon, n)
+    def fit():
+        Xs = np.concatenate([np.column_stack([X[:n - h + 1], np.full(n - h + 1, h/horizon, X.dtype)])
+                             for h in leads])
+        model = make()
+        model.fit(Xs, np.concatenate([y[h - 1:] for h in leads]))
+        return model
+    model = _cached_fit(name, {**key, 'stacked': True}, time_series, fit, SERIALIZERS.get(module))
+    lead = (np.arange(1, horizon + 1)/horizon).astype(X.dtype)
+    return model.predict(np.column_stack([np.repeat(X[-1:], horizon, axis=0), lead]))
+
+def _standardise(a):
+    """(a - mean)/std along axis 0, with the mean and std (1 where constant) to undo it"""
+    mean, std = a.mean(axis=0), a.std(axis=0)
+    std = np.where(std > 0, std, 1).astype(a.dtype)
+    return (a - mean)/std, mean, std
+
+# Penalised and kernel estimators fit standardised features and target, like _mv_regressor
+STANDARDISED_MODULES = ('sklearn.linear_model', 'sklearn.svm')
+
+def _regressor(module, cls, **params):
+    def predict(time_series, features=None, horizon=None):
+        feats = features or lag_features(time_series)
+        X = feats.matrix.astype(float) if module in FLOAT64_MODULES else feats.matrix
+        window, key, mx, sx, mt, st = feats.lags[-1], params, 0.0, 1.0, 0.0, 1.0
+        if module in STANDARDISED_MODULES:
+            X, mx, sx = _standardise(X)
+            target, mt, st = _standardise(feats.target)
+            feats = LagFeatures(X, target, feats.n_lags)
+            # Keeps models cached before standardisation from being reused
+            key = {**params, 'standardised': True}
+        if horizon is not None and horizon > 1 and len(feats.target) > 2*horizon:
+            return _direct(module, cls, params, X, feats, horizon, time_series, key)*st + mt
+        def fit():
+            model = getattr(importlib.import_module(module), cls)(**params)
+            model.fit(X[:-1], feats.target)
+            return model
+        model = _cached_fit(f"{module}.{cls}", {**key, 'n_lags': feats.n_lags}, time_series, fit,
+                            SERIALIZERS.get(module))
+        if horizon is None:
+            return model.predict(X[-1:])[0]*st + mt
+        # Series too short to hold a target for every lead: feed one-step forecasts back
+        return _recursive(lambda row: model.predict((row - mx)/sx)*st + mt, window, horizon, X.dtype)
+    return predict
+
+REGRESSORS = [
+    ('xgboost', 'xgboost', 'XGBRegressor', {}),
+    ('lightgbm', 'lightgbm', 'LGBMRegressor', {}),
+    ('catboost', 'catboost', 'CatBoostRegressor', {'verbose': 0}),
+    ('random_forest', 'sklearn.ensemble', 'RandomForestRegressor', {}),
+    ('gradient_boosting', 'sklearn.ensemble', 'GradientBoostingRegressor', {}),
+    ('extra_trees', 'sklearn.ensemble', 'ExtraTreesRegressor', {}),
+    ('hist_gradient_boosting', 'sklearn.ensemble', 'HistGradientBoostingRegressor', {}),
+    ('svr', 'sklearn.svm', 'SVR', {}),
+    ('ridge', 'sklearn.linear_model', 'Ridge', {}),
+    # The target is standardised, so the default alpha=1 would zero every coefficient
+    ('lasso', 'sklearn.linear_model', 'Lasso', {'alpha': 1e-3}),
+    ('bayesian_ridge', 'sklearn.linear_model', 'BayesianRidge', {}),
+]
+for name, module, cls, params in REGRESSORS:
+    register(name, module, features=True)(_regressor(module, cls, **params))
+
+# Deep Learning Models
+KERAS_EPOCHS = 10
+KERAS_CONFIG = {'intra_op_threads': None, 'inter_op_threads': None, 'fine_tune_epochs': None}
+_KERAS_POOL = {}
+_KERAS_POOL_LOCK = threading.Lock()
+
+def configure_keras(intra_op_threads=None, inter_op_threads=None, fine_tune_epochs=None):
+    """TensorFlow thread counts and warm fine-tuning for the pooled deep members.
+
+    Thread counts only take effect if set before TensorFlow first runs in this
+    process. With fine_tune_epochs a pooled model that has been trained before
+    continues from its current weights for that many epochs instead of being
+    reset and trained for the full KERAS_EPOCHS.
+    """
+    KERAS_CONFIG.update(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads,
+                        fine_tune_epochs=fine_tune_epochs)
+
+def _apply_tf_threads(tf):
+    try:
+        if KERAS_CONFIG['intra_op_threads']:
+            tf.config.threading.set_intra_op_parallelism_threads(int(KERAS_CONFIG['intra_op_threads']))
+        if KERAS_CONFIG['inter_op_threads']:
+            tf.config.threading.set_inter_op_parallelism_threads(int(KERAS_CONFIG['inter_op_threads']))
+    except RuntimeError:
+        pass  # runtime already initialised; the counts are fixed for this process
+
+def _masked_mse(tf):
+    """MSE over the finite targets only; the last windows have no target for far leads"""
+    def loss(y_true, y_pred):
+        seen = tf.math.is_finite(y_true)
+        err = tf.where(seen, y_true - y_pred, tf.zeros_like(y_pred))
+        return tf.reduce_sum(err*err, axis=-1)/tf.maximum(tf.reduce_sum(tf.cast(seen, y_pred.dtype), axis=-1), 1.0)
+    return loss
+
+class _WarmKeras:
+    """A model built and compiled once per process, reset or fine-tuned on each fit.
+
+    outputs > 1 makes the last layer a direct multi-step head (one unit per
+    lead). Inference goes through a tf.function traced once for
+    (batch, n_lags, 1) float32 windows instead of the Keras predict loop.
+    """
+    def __init__(self, build, n_lags, outputs=1):
+        import tensorflow as tf
+        _apply_tf_threads(tf)
+        self.tf = tf
+        self.model = build(outputs)
+        self.model.compile(optimizer='adam', loss=_masked_mse(tf))
+        self.initial = self.model.get_weights()
+        self.trained = False
+        self.lock = threading.Lock()
+        self.infer = tf.function(lambda x: self.model(x, training=False),
+                                 input_signature=[tf.TensorSpec([None, n_lags, 1], tf.float32)])
+
+    def _reset(self):
+        self.model.set_weights(self.initial)
+        opt_vars = self.model.optimizer.variables
+        for v in (opt_vars() if callable(opt_vars) else opt_vars):
+            v.assign(self.tf.zeros_like(v))
+
+    def fit(self, X, y):
+        """Train and return a snapshot of the weights (what the model cache stores)"""
+        epochs = KERAS_CONFIG['fine_tune_epochs'] if self.trained else None
+        if not epochs:
+            self._reset()
+            epochs = KERAS_EPOCHS
+        self.model.fit(X, y, epochs=int(epochs), verbose=0)
+        self.trained = True
+        return self.model.get_weights()
+
+    def predict(self, weights, X):
+        """Every output (the next step, or leads 1..outputs) from the window X (1, n_lags, 1)"""
+        self.model.set_weights(weights)
+        return self.infer(np.asarray(X, dtype=np.float32)).numpy()[0]
+
+def _warm_keras(build, n_lags, outputs=1):
+    key = (build.__name__, n_lags, outputs)
+    with _KERAS_POOL_LOCK:
+        if key not in _KERAS_POOL:
+            _KERAS_POOL[key] = _WarmKeras(build, n_lags, outputs)
+        return _KERAS_POOL[key]
+
+def _save_weights(weights, path):
+    np.savez(path, *weights)
+
+def _load_weights(path):
+    with np.load(path) as f:
+        return [f[f'arr_{i}'] for i in range(len(f.files))]
+
+def _keras(build):
+    def predict(time_series, features=None, horizon=None):
+        feats = features or lag_features(time_series)
+        # Min-max scale the shared lag windows rather than re-windowing the series
+        y = np.asarray(time_series, dtype=float)
+        lo, span = y.min(), np.ptp(y) or 1.0
+        X = ((feats.lags - lo)/span)[:, :, None]
+        # Direct multi-step targets, NaN (masked in the loss) past the end of the series
+        outputs = horizon or 1
+        target = np.concatenate([(feats.target - lo)/span, np.full(outputs - 1, np.nan)])
+        X_dl, y_dl = X[:-1], sliding_window_view(target, outputs).astype(np.float32)
+        warm = _warm_keras(build, feats.n_lags, outputs)
+        with warm.lock:
+            weights = _cached_fit(build.__name__,
+                                  {'epochs': KERAS_EPOCHS, 'window': feats.n_lags, 'outputs': outputs}, y,
+                                  lambda: warm.fit(X_dl, y_dl), ('npz', _save_weights, _load_weights))
+            pred = warm.predict(weights, X[-1:])
+        return _steps(pred*span + lo, horizon)
+    predict.build = build
+    return predict
+
+@register('lstm', 'tensorflow', features=True)
+@_keras
+def lstm(outputs=1):
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import LSTM, Dense
+    return Sequential([LSTM(10, input_shape=(5,1)), Dense(outputs)])
+
+@register('gru', 'tensorflow', features=True)
+@_keras
+def gru(outputs=1):
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import GRU, Dense
+    return Sequential([GRU(10, input_shape=(5,1)), Dense(outputs)])
+
+@register('cnn', 'tensorflow', features=True)
+@_keras
+def cnn(outputs=1):
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Conv1D, Dense, Flatten
+    return Sequential([Conv1D(16, 2, activation='relu', input_shape=(5,1)), Flatten(), Dense(outputs)])
+
+# Multivariate models
+MULTIVARIATE = ('var', 'ridge', 'random_forest', 'extra_trees')
+
+def _mv_regressor(name, Z, n_lags, horizon):
+    """Multi-output regressor on the lag windows of all (standardised) channels at once"""
+    module, cls, params = next((m, c, p) for n, m, c, p in REGRESSORS if n == name)
+    if cls not in MULTI_OUTPUT:
+        raise ValueError(f"{name} has no native multi-output fit")
+    params = {**params, **MULTI_OUTPUT[cls]}
+    mean, std = Z.mean(axis=0), Z.std(axis=0)
+    std = np.where(std > 0, std, 1.0)
+    S = (Z - mean)/std
+    # (n_rows, n_channels*n_lags), channel-major like a transposed lag window
+    X = sliding_window_view(S.astype(np.float32), n_lags, axis=0).reshape(len(S) - n_lags + 1, -1)
+    if module in FLOAT64_MODULES:
+        X = X.astype(float)
+    def fit():
+        model = getattr(importlib.import_module(module), cls)(**params)
+        model.fit(X[:-1], S[n_lags:])
+        return model
+    model = _cached_fit(f"{module}.{cls}", {**params, 'n_lags': n_lags, 'multivariate': True}, Z, fit,
+                        SERIALIZERS.get(module))
+    w = S[-n_lags:].copy()
+    out = np.empty((horizon, Z.shape[1]))
+    for h in range(horizon):
+        out[h] = model.predict(w.T.reshape(1, -1).astype(X.dtype))[0]
+        w = np.vstack([w[1:], out[h]])
+    return out*std + mean
+
+def _var_paths(Z, horizon):
+    from statsmodels.tsa.vector_ar.var_model import VAR
+    fit = VAR(Z).fit()
+    return fit.forecast(Z[-fit.k_ar:], steps=horizon)
+
+def multivariate_predict(frame, models=None, horizon=None, n_lags=N_LAGS, return_report=False):
+    """Joint forecast of every channel of a simulation frame (or 2-D array, time on axis 0).
+
+    Each model is fit once on all channels: VAR on the raw values, multi-output
+    regressors on the stacked lag windows of every standardised channel.
+    Channels that stay constant over the history are carried forward as is.
+    Returns a models x channels DataFrame of next steps, or with horizon an
+    (n_models, horizon, n_channels) array; failed models give NaN.
+    """
+    models = list(models or MULTIVARIATE)
+    if isinstance(frame, pd.DataFrame):
+        channels = [c for c in frame.columns if c != 'Time_h']
+        Z = frame[channels].to_numpy(dtype=float)
+    else:
+        Z = np.asarray(frame, dtype=float)
+        channels = list(range(Z.shape[1]))
+    if Z.ndim != 2 or len(Z) <= n_lags:
+        raise ValueError(f"Need a (n_times, n_channels) history longer than n_lags={n_lags}")
+    varying = np.ptp(Z, axis=0) > 0
+    steps = horizon or 1
+    out = np.tile(Z[-1], (len(models), steps, 1))
+    report = []
+    for i, name in enumerate(models):
+        t0 = time.perf_counter()
+        try:
+            if varying.any():
+                fn = _var_paths if name == 'var' else lambda Zv, h: _mv_regressor(name, Zv, n_lags, h)
+                out[i][:, varying] = fn(Z[:, varying], steps)
+            report.append({'model': name, 'status': 'ok', 'wall_time': time.perf_counter() - t0, 'error': None})
+        except Exception as e:
+            out[i] = np.nan
+            report.append({'model': name, 'status': 'error', 'wall_time': time.perf_counter() - t0,
+                           'error': repr(e)})
+    res = out if horizon is not None else pd.DataFrame(out[:, 0], index=list(models), columns=channels)
+    return (res, report) if return_report else res
+
+# Global multi-series model
+def _as_panel(series):
+    """(n_series, n_times) float array from a 2-D array, a DataFrame (one column per series) or a list"""
+    if isinstance(series, pd.DataFrame):
+        return series.to_numpy(dtype=float).T
+    panel = np.asarray(series, dtype=float)
+    if panel.ndim != 2:
+        raise ValueError("Expected a 2-D panel of equal-length series")
+    return panel
+
+class GlobalForecaster:
+    """One gradient-boosted model trained on lag windows pooled across many series.
+
+    Each series is standardised by its own mean and std, its windows of n_lags
+    values become rows of a single training matrix with the series id as a
+    categorical feature, and one vectorized predict call returns the next step
+    of every series. backend is 'lightgbm' or 'xgboost'.
+    """
+    def __init__(self, backend='lightgbm', n_lags=12, params=None, series_id=True):
+        if backend not in ('lightgbm', 'xgboost'):
+            raise ValueError(f"Unknown global backend {backend!r}")
+        self.backend = backend
+        self.n_lags = n_lags
+        self.params = params or {}
+        self.series_id = series_id
+        self.model = None
+
+    def _scale(self, panel):
+        self.mean = panel.mean(axis=1, keepdims=True)
+        std = panel.std(axis=1, keepdims=True)
+        self.std = np.where(std > 0, std, 1.0)
+
+    def _design(self, lags):
+        """Rows of (n_series, n_rows, n_lags) lags plus the series id column"""
+        n_series, n_rows, _ = lags.shape
+        X = lags.reshape(n_series*n_rows, self.n_lags).astype(np.float32)
+        if not self.series_id:
+            return X
+        ids = np.repeat(np.arange(n_series), n_rows)
+        if self.backend == 'xgboost':
+            X = pd.DataFrame(X, columns=[f'lag{k}' for k in range(self.n_lags, 0, -1)])
+            X['series'] = pd.Categorical(ids, categories=np.arange(self.n_series))
+            return X
+        return np.column_stack([X, ids.astype(np.float32)])
+
+    def fit(self, series):
+        panel = _as_panel(series)
+        if panel.shape[1] <= self.n_lags:
+            raise ValueError(f"Series need more than n_lags={self.n_lags} points")
+        self.n_series = len(panel)
+        self._scale(panel)
+        W = sliding_window_view((panel - self.mean)/self.std, self.n_lags + 1, axis=1)
+        X, y = self._design(W[:, :, :-1]), W[:, :, -1].ravel()
+        if self.backend == 'lightgbm':
+            from lightgbm import LGBMRegressor
+            self.model = LGBMRegressor(**{'verbose': -1, **self.params})
+            cat = [self.n_lags] if self.series_id else 'auto'
+            self.model.fit(X, y, categorical_feature=cat)
+        else:
+            from xgboost import XGBRegressor
+            self.model = XGBRegressor(**{'tree_method': 'hist', 'enable_categorical': True, **self.params})
+            self.model.fit(X, y)
+        self.last = panel[:, -self.n_lags:]
+        return self
+
+    def predict(self, series=None, horizon=None):
+        """Next step of every series, or (n_series, horizon) by recursion batched over series.
+
+        Defaults to the tails of the panel passed to fit.
+        """
+        tail = self.last if series is None else _as_panel(series)[:, -self.n_lags:]
+        if len(tail) != self.n_series:
+            raise ValueError(f"Fitted on {self.n_series} series, got {len(tail)}")
+        w = (tail - self.mean)/self.std
+        out = np.empty((self.n_series, horizon or 1))
+        for h in range(horizon or 1):
+            out[:, h] = self.model.predict(self._design(w[:, None, :]))
+            w = np.column_stack([w[:, 1:], out[:, h]])
+        out = out*self.std + self.mean
+        return out[:, 0] if horizon is None else out
+
+def global_predict(series, backend='lightgbm', n_lags=12, params=None, horizon=None):
+    """Fit one GlobalForecaster on the panel and return each series' next step (or horizon)"""
+    return GlobalForecaster(backend, n_lags, params).fit(series).predict(horizon=horizon)
+
+def local_predict(series, models=('lightgbm',), **kw):
+    """Per-series ensemble_predict over the same panel, for comparison with global_predict"""
+    return np.array([ensemble_predict(row, models=list(models), **kw) for row in _as_panel(series)])
+
+def _timed(name, time_series, features=None, horizon=None):
+    """Worker entry point; looks the model up by name so it pickles for process pools"""
+    t0 = time.perf_counter()
+    kw = {} if features is None else {'features': features}
+    if horizon is not None:
+        kw['horizon'] = horizon
+    value = REGISTRY[name].predict(time_series, **kw)
+    value = float(value) if horizon is None else np.asarray(value, dtype=float)
+    return value, time.perf_counter() - t0
+
+_POOLS = {}
+
+def _pool(kind, max_workers):
+    """Shared pool of kind with at least max_workers workers (a smaller one is replaced)"""
+    pool = _POOLS.get(kind)
+    if pool is not None and pool._max_workers < max_workers:
+        pool.shutdown(wait=False)
+        pool = None
+    if pool is None:
+        if kind == 'process':
+            # spawn: forking next to running booster/BLAS threads can deadlock the child
+            pool = ProcessPoolExecutor(max_workers=max_workers,
+                                       mp_context=multiprocessing.get_context('spawn'))
+        else:
+            pool = ThreadPoolExecutor(max_workers=max_workers)
+        _POOLS[kind] = pool
+    return pool
+
+def _retire_pool(kind):
+    """Stop handing out a pool that has overrunning work; later calls get a fresh one"""
+    pool = _POOLS.get(kind)
+    if pool is not None:
+        del _POOLS[kind]
+    return pool
+
+def _discard_pool(pool):
+    """Shut a retired pool down; threads cannot be stopped, but stuck fit processes can"""
+    # shutdown() clears _processes, so take the workers first
+    procs = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False)
+    for proc in procs:
+        proc.terminate()
+
+def _run_sequential(time_series, models, deadline, features, horizon):
+    report = []
+    t_start = time.perf_counter()
+    for name in models:
+        if deadline is not None and time.perf_counter() - t_start > deadline:
+            report.append({'model': name, 'status': 'skipped', 'value': np.nan,
+                           'wall_time': 0.0, 'error': 'ensemble deadline reached'})
+            continue
+        t0 = time.perf_counter()
+        try:
+            value, _ = _timed(name, time_series, features if REGISTRY[name].features else None, horizon)
+            report.append({'model': name, 'status': 'ok', 'value': value,
+                           'wall_time': time.perf_counter() - t0, 'error': None})
+        except Exception as e:
+            report.append({'model': name, 'status': 'error', 'value': np.nan,
+                           'wall_time': time.perf_counter() - t0, 'error': repr(e)})
+    return report
+
+def _run_parallel(time_series, models, timeout, deadline, max_workers, features, horizon):
+    """Run members in their pools, never more at once than a pool has workers.
+
+    Each member's timeout counts from its own submission, so members waiting
+    for a worker cannot expire. A pool with a timed-out member is retired:
+    its siblings finish undisturbed and its processes are terminated after.
+    """
+    # First imports of scipy/sklearn racing in worker threads can deadlock; do them here
+    for name in models:
+        if REGISTRY[name].pool == 'thread':
+            try:
+                import_backends([name])
+            except Exception:
+                pass  # the member reports its own ImportError when it runs
+    t_start = time.perf_counter()
+    limit = {name: (timeout.get(name) if isinstance(timeout, dict) else timeout) for name in models}
+    queues = {}
+    # Start the process-pool members first so their workers spin up while threads run
+    for name in sorted(models, key=lambda m: REGISTRY[m].pool != 'process'):
+        queues.setdefault(REGISTRY[name].pool, []).append(name)
+    slots = {kind: max_workers or len(names) for kind, names in queues.items()}
+    futures, started, pool_of = {}, {}, {}
+    retired = set()
+    results = {}
+    pending = set()
+
+    def submit():
+        for kind, names in queues.items():
+            while names and sum(REGISTRY[futures[f]].pool == kind for f in pending) < slots[kind]:
+                name = names.pop(0)
+                pool = _pool(kind, slots[kind])
+                feats = features if REGISTRY[name].features else None
+                f = pool.submit(_timed, name, time_series, feats, horizon)
+                futures[f], started[f], pool_of[f] = name, time.perf_counter(), pool
+                pending.add(f)
+
+    submit()
+    while pending:
+        now = time.perf_counter()
+        expiries = [started[f] + limit[futures[f]] for f in pending if limit[futures[f]] is not None]
+        if deadline is not None:
+            expiries.append(t_start + deadline)
+        wait_for = max(0.0, min(expiries) - now) if expiries else None
+        done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+        now = time.perf_counter()
+        for f in done:
+            pending.discard(f)
+            name = futures[f]
+            if f.cancelled():
+                results[name] = {'status': 'error', 'value': np.nan, 'wall_time': now - started[f],
+                                 'error': 'cancelled'}
+                continue
+            try:
+                value, wall = f.result()
+                results[name] = {'status': 'ok', 'value': value, 'wall_time': wall, 'error': None}
+            except Exception as e:
+                results[name] = {'status': 'error', 'value': np.nan, 'wall_time': now - started[f],
+                                 'error': repr(e)}
+        over_deadline = deadline is not None and now - t_start >= deadline
+        for f in list(pending):
+            name = futures[f]
+            if over_deadline or (limit[name] is not None and now - started[f] >= limit[name]):
+                pending.discard(f)
+                results[name] = {'status': 'timeout', 'value': np.nan, 'wall_time': now - started[f],
+                                 'error': 'ensemble deadline reached' if over_deadline else
+                                          f'exceeded {limit[name]}s timeout'}
+                if _POOLS.get(REGISTRY[name].pool) is pool_of[f]:
+                    retired.add(_retire_pool(REGISTRY[name].pool))
+        for pool in [p for p in retired if not any(pool_of[f] is p for f in pending)]:
+            _discard_pool(pool)
+            retired.discard(pool)
+        if over_deadline:
+            for names in queues.values():
+                for name in names:
+                    results[name] = {'status': 'skipped', 'value': np.nan, 'wall_time': 0.0,
+                                     'error': 'ensemble deadline reached'}
+                names.clear()
+        submit()
+    return [{'model': name, **results[name]} for name in models]
+
+def ensemble_predict(time_series, models=None, parallel=False, timeout=None, deadline=None,
+                     max_workers=None, return_report=False, weights=None, horizon=None):
+    """Mean next-step forecast over the selected forecasters (default: all registered).
+
+    With parallel=True members run concurrently in process or thread pools. timeout
+    (seconds, or a dict per model) bounds each member and deadline the whole
+    ensemble; the mean is taken over whatever finished in time. Sequential runs
+    honour deadline between members. return_report adds a per-model list of
+    status, value, wall time and error. weights (model -> weight, e.g. from
+    backtest.stacking_weights) replace the plain mean with a weighted one,
+    renormalised over the members that finished.
+
+    With horizon set the result is instead an (n_models, horizon) array of
+    every member's multi-step forecast, rows in models order and NaN for
+    members that did not finish.
+    """
+    models = models or list(REGISTRY)
+    unknown = set(models) - set(REGISTRY)
+    if unknown:
+        raise ValueError(f"Unknown forecasters: {sorted(unknown)}")
+    # Lag features are built once and shared by every regressor and deep model
+    features = None
+    if any(REGISTRY[m].features for m in models):
+        try:
+            features = lag_features(time_series)
+        except ValueError:
+            pass  # multivariate or too short; members build (and report) their own
+    if parallel:
+        report = _run_parallel(time_series, models, timeout, deadline, max_workers, features, horizon)
+    else:
+        report = _run_sequential(time_series, models, deadline, features, horizon)
+    if horizon is not None:
+        paths = np.full((len(models), horizon), np.nan)
+        for i, r in enumerate(report):
+            if r['status'] == 'ok':
+                paths[i] = r['value']
+        return (paths, report) if return_report else paths
+    ok = [r for r in report if r['status'] == 'ok']
+    if weights is not None:
+        w = np.array([weights.get(r['model'], 0.0) for r in ok])
+        pred = np.dot(w, [r['value'] for r in ok])/w.sum() if w.sum() > 0 else np.nan
+    else:
+        # Average all model predictions
+        pred = np.mean([r['value'] for r in ok]) if ok else np.nan
+    return (pred, report) if return_report else pred
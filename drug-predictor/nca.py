@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+NCA_KEYS = ['Cmax', 'Tmax', 'Clast', 'AUC_0_t', 'AUC_0_t_log', 'lambda_z', 't_half', 'span_ratio',
+            'AUC_inf', 'CL', 'Vz']
+
+def auc_linear(t, conc):
+    """Linear-trapezoid AUC over the last axis"""
+    return np.trapz(conc, t, axis=-1)
+
+def auc_lin_up_log_down(t, conc):
+    """Linear trapezoid while rising, log trapezoid on declining positive intervals"""
+    dt = np.diff(t)
+    c1, c2 = conc[..., :-1], conc[..., 1:]
+    log_down = (c2 < c1) & (c2 > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_part = (c1 - c2)*dt/np.log(np.where(log_down, c1/c2, 2.0))
+    return np.where(log_down, log_part, 0.5*(c1 + c2)*dt).sum(axis=-1)
+
+def terminal_slope(t, conc, n_points=None, tmax=None, tol=1e-4, return_span=False):
+    """Vectorized log-linear terminal fit on positive samples after Tmax.
+
+    By default every trailing run of at least 3 such samples is fitted at once
+    (cumulative sums from the end) and the one with the best adjusted R^2 is
+    kept, preferring more points among fits within tol of the best. An int
+    n_points fits the last n_points samples instead. Returns lambda_z with NaN
+    where fewer than 3 usable points remain or the fitted slope is not negative;
+    return_span adds the time covered by the fitted points.
+    """
+    x = t if n_points is None else t[-n_points:]
+    c = conc if n_points is None else conc[..., -n_points:]
+    w = c > 0
+    if tmax is not None:
+        w &= x > np.asarray(tmax)[..., None]
+    y = np.log(np.where(w, c, 1.0))
+    if n_points is None:
+        # Statistics of the last k samples for every k, weighted by validity
+        tail = lambda a: np.cumsum(a[..., ::-1], axis=-1)
+    else:
+        tail = lambda a: a.sum(-1)[..., None]
+    sw, sx, sy = tail(w*1.0), tail(w*x), tail(w*y)
+    sxx, sxy, syy = tail(w*x*x), tail(w*x*y), tail(w*y*y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vx, vy, cxy = sxx - sx*sx/sw, syy - sy*sy/sw, sxy - sx*sy/sw
+        slope = cxy/vx
+        r2 = np.where(vy > 0, cxy*cxy/(vx*vy), 1.0)
+        adj = 1.0 - (1.0 - r2)*(sw - 1)/(sw - 2)
+    # A fit only counts where its earliest sample is itself a valid point
+    ok = (sw >= 3) & (slope < 0) & (w[..., ::-1] if n_points is None else True)
+    adj = np.where(ok, adj, -np.inf)
+    best = adj.max(axis=-1, keepdims=True)
+    pick = adj >= best - tol
+    k = pick.shape[-1] - 1 - np.argmax(pick[..., ::-1], axis=-1)
+    lam = -np.take_along_axis(slope, k[..., None], axis=-1)[..., 0]
+    lam = np.where(np.isfinite(best[..., 0]), lam, np.nan)
+    if not return_span:
+        return lam
+    first = x[len(x) - 1 - k] if n_points is None else np.where(w, x, np.inf).min(-1)
+    span = np.where(np.isnan(lam), np.nan, np.where(w, x, -np.inf).max(-1) - first)
+    return lam, span
+
+def nca(t, conc, dose=None, n_terminal=None, auc=None):
+    """Non-compartmental analysis of conc with time on the last axis.
+
+    conc may be (n_times,), (n_subjects, n_times) or carry any further leading
+    axes such as compartments; every metric comes back with the leading shape.
+    CL and Vz need the administered dose and are NaN without it. span_ratio
+    is the time covered by the terminal fit over t_half; below about 2 the
+    profile may not reach its terminal phase. auc, if
+    given, is an exact AUC_0_t (e.g. PBPKQSPSimulator.pk_auc) used instead of
+    the trapezoid.
+    """
+    t = np.asarray(t, dtype=float)
+    conc = np.asarray(conc, dtype=float)
+    imax = conc.argmax(axis=-1)
+    tmax = t[imax]
+    clast = conc[..., -1]
+    auc = auc_linear(t, conc) if auc is None else np.broadcast_to(np.asarray(auc, dtype=float), conc.shape[:-1])
+    lam, span = terminal_slope(t, conc, n_terminal, tmax=tmax, return_span=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auc_inf = auc + clast/lam
+        cl = np.nan if dose is None else dose/auc_inf
+        vz = np.nan if dose is None else dose/(lam*auc_inf)
+        t_half = np.log(2)/lam
+        span_ratio = span/t_half
+    return {
+        'Cmax': conc.max(axis=-1),
+        'Tmax': tmax,
+        'Clast': clast,
+        'AUC_0_t': auc,
+        'AUC_0_t_log': auc_lin_up_log_down(t, conc),
+        'lambda_z': lam,
+        't_half': t_half,
+        'span_ratio': span_ratio,
+        'AUC_inf': auc_inf,
+        'CL': np.broadcast_to(cl, auc.shape),
+        'Vz': np.broadcast_to(vz, auc.shape),
+    }
+
+def nca_frame(df, compartments=None, dose=None, n_terminal=None):
+    """NCA of every compartment of a simulate() frame in one vectorized pass"""
+    compartments = compartments or [c for c in df.columns if c != 'Time_h']
+    res = nca(df['Time_h'].to_numpy(), df[compartments].to_numpy().T, dose=dose,
+              n_terminal=n_terminal)
+    return pd.DataFrame(res, index=compartments)
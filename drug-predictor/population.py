@@ -0,0 +1,351 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, fields
+from multiprocessing.shared_memory import SharedMemory
+from scipy.integrate import solve_ivp
+from scipy.linalg import expm
+from scipy.sparse import bsr_matrix
+from app import (Physiology, Compound, PBPKQSPSimulator, BLOOD,
+                 pk_rate_matrix, dose_segments, time_grid, load_config, model_from_config)
+from nca import nca
+
+PHYS_FIELDS = [f.name for f in fields(Physiology)]
+
+@dataclass
+class ParamDistribution:
+    """Sampling distribution for one Physiology field"""
+    dist: str = 'lognormal'
+    mean: float = 1.0
+    cv: float = 0.0
+    low: float = None
+    high: float = None
+
+    def sample(self, n, rng, max_redraws=100):
+        """n positive draws; normal draws at or below zero are redrawn (a truncated normal)"""
+        if self.dist in ('normal', 'lognormal') and self.mean <= 0:
+            raise ValueError(f"{self.dist} distribution needs a positive mean, got {self.mean}")
+        if self.dist == 'fixed' or self.cv == 0.0:
+            x = np.full(n, float(self.mean))
+        elif self.dist == 'normal':
+            x = rng.normal(self.mean, self.cv*self.mean, n)
+            for _ in range(max_redraws):
+                bad = x <= 0
+                if not bad.any():
+                    break
+                x[bad] = rng.normal(self.mean, self.cv*self.mean, bad.sum())
+        elif self.dist == 'lognormal':
+            # Parameterised by arithmetic mean and CV of the sampled values
+            sigma2 = np.log1p(self.cv**2)
+            x = rng.lognormal(np.log(self.mean) - 0.5*sigma2, np.sqrt(sigma2), n)
+        elif self.dist == 'uniform':
+            x = rng.uniform(self.low, self.high, n)
+        else:
+            raise ValueError(f"Unknown distribution: {self.dist}")
+        if self.low is not None or self.high is not None:
+            x = np.clip(x, self.low, self.high)
+        if not (x > 0).all():
+            raise ValueError(f"{self.dist} distribution (mean={self.mean}, cv={self.cv}) "
+                             f"gives non-positive physiology values")
+        return x
+
+def sample_physiology(n, distributions, base=None, seed=None):
+    """Draw n subjects; fields without a distribution keep their base value"""
+    base = base or Physiology()
+    rng = np.random.default_rng(seed)
+    phys = {k: np.full(n, float(getattr(base, k))) for k in PHYS_FIELDS}
+    for k, d in distributions.items():
+        if k not in phys:
+            raise ValueError(f"Unknown Physiology field: {k}")
+        if not isinstance(d, ParamDistribution):
+            d = ParamDistribution(**d)
+        phys[k] = d.sample(n, rng)
+    return phys
+
+def physiology_arrays(phys_array):
+    """Normalise a Physiology of arrays or a field->array mapping to equal-length 1-D arrays"""
+    if isinstance(phys_array, Physiology):
+        phys_array = {k: getattr(phys_array, k) for k in PHYS_FIELDS}
+    default = Physiology()
+    cols = [np.atleast_1d(np.asarray(phys_array.get(k, getattr(default, k)), dtype=float))
+            for k in PHYS_FIELDS]
+    return dict(zip(PHYS_FIELDS, np.broadcast_arrays(*cols)))
+
+class PopulationSimulator:
+    """PBPK/QSP model for n subjects integrated as one (n_subjects x n_states) state.
+
+    Without tissues, the built-in Liver/Muscle/Fat set takes its volumes, flows
+    and CLint from each subject's physiology; declared tissues (see Tissue) are
+    shared by every subject, which then differ only in V_blood.
+    """
+    def __init__(self, phys_array, cmpd: Compound, qsp_params=None, tissues=None):
+        p = physiology_arrays(phys_array)
+        self.phys = p
+        self.cmpd = cmpd
+        self.qsp = qsp_params
+        self.tissues = list(tissues) if tissues else None
+        self.n = len(p['V_blood'])
+        ones, zeros = np.ones(self.n), np.zeros(self.n)
+        if self.tissues:
+            self.names = ['Gut', 'Blood'] + [t.name for t in self.tissues]
+            const = lambda attr: [np.full(self.n, getattr(t, attr)) for t in self.tissues]
+            vols = np.stack([ones, p['V_blood']] + const('volume'), axis=-1)
+            flows = np.stack([zeros, zeros] + const('flow'), axis=-1)
+            kps = np.array([1.0, 1.0] + [t.kp for t in self.tissues])
+            clint = np.stack([zeros, zeros] + const('clearance'), axis=-1)
+        else:
+            self.names = ['Gut','Blood','Liver','Muscle','Fat']
+            vols = np.stack([ones, p['V_blood'], p['V_liver'], p['V_muscle'], p['V_fat']], axis=-1)
+            flows = np.stack([zeros, zeros, p['Q_liver'], p['Q_muscle'], p['Q_fat']], axis=-1)
+            kps = np.array([1.0, 1.0, cmpd.Kp_liver, cmpd.Kp_muscle, cmpd.Kp_fat])
+            clint = np.stack([zeros, zeros, p['CLint_liver'], zeros, zeros], axis=-1)
+        self.A = pk_rate_matrix(vols, flows, kps, clint, cmpd.k_abs)
+        self.inv_vb = 1.0/p['V_blood']
+        self.n_pk = len(self.names)
+        self.n_qsp = 3 if qsp_params else 0
+        self.n_states = self.n_pk + self.n_qsp
+        self._props = {}
+
+    def initial_state(self):
+        y0 = np.zeros((self.n, self.n_states))
+        if self.qsp:
+            y0[:, self.n_pk] = self.qsp[2]
+        return y0
+
+    def columns(self):
+        cols = self.names.copy()
+        if self.qsp:
+            cols += ['Free_Receptor','Drug_Receptor_Complex','Biomarker']
+        return cols
+
+    def qsp_rates(self, Cb, Z):
+        kon, koff, Rtot, kprod, kdeg = self.qsp
+        Rf, Rc, M = Z[:, 0], Z[:, 1], Z[:, 2]
+        bind = kon*Cb*Rf - koff*Rc
+        return np.stack([-bind, bind, kprod*Rc - kdeg*M], axis=-1)
+
+    def odes(self, t, y, inj):
+        Y = y.reshape(self.n, self.n_states)
+        dY = np.empty_like(Y)
+        dY[:, :self.n_pk] = np.einsum('sij,sj->si', self.A, Y[:, :self.n_pk]) + inj
+        if self.qsp:
+            dY[:, self.n_pk:] = self.qsp_rates(Y[:, BLOOD]*self.inv_vb, Y[:, self.n_pk:])
+        return dY.ravel()
+
+    def jac(self, t, y):
+        """Block-diagonal sparse Jacobian, one dense block per subject"""
+        J = np.zeros((self.n, self.n_states, self.n_states))
+        J[:, :self.n_pk, :self.n_pk] = self.A
+        if self.qsp:
+            kon, koff, Rtot, kprod, kdeg = self.qsp
+            Y = y.reshape(self.n, self.n_states)
+            Cb, Rf = Y[:, BLOOD]*self.inv_vb, Y[:, self.n_pk]
+            rf, rc, m = self.n_pk, self.n_pk + 1, self.n_pk + 2
+            J[:, rf, BLOOD] = -kon*Rf*self.inv_vb
+            J[:, rc, BLOOD] = kon*Rf*self.inv_vb
+            J[:, rf, rf] = -kon*Cb
+            J[:, rc, rf] = kon*Cb
+            J[:, rf, rc] = koff
+            J[:, rc, rc] = -koff
+            J[:, m, rc] = kprod
+            J[:, m, m] = -kdeg
+        idx = np.arange(self.n)
+        size = self.n*self.n_states
+        return bsr_matrix((J, idx, np.arange(self.n + 1)), shape=(size, size))
+
+    def propagator(self, h):
+        """Per-subject exact PK steps over h, stacked as (n, n_pk, n_pk)"""
+        key = round(h, 12)
+        P = self._props.get(key)
+        if P is None:
+            n = self.n_pk
+            M = np.zeros((self.n, 2*n, 2*n))
+            M[:, :n, :n] = self.A*h
+            M[:, :n, n:] = np.eye(n)*h
+            E = expm(M)
+            P = self._props[key] = (E[:, :n, :n], E[:, :n, n:])
+        return P
+
+    def auc_propagator(self, h):
+        """Per-subject exact PK integrals over h, as in PBPKQSPSimulator.auc_propagator"""
+        key = ('auc', round(h, 12))
+        P = self._props.get(key)
+        if P is None:
+            n = self.n_pk
+            M = np.zeros((self.n, 3*n, 3*n))
+            M[:, :n, :n] = self.A*h
+            M[:, :n, n:2*n] = M[:, n:2*n, 2*n:] = np.eye(n)*h
+            E = expm(M)
+            P = self._props[key] = (E[:, :n, n:2*n], E[:, :n, 2*n:])
+        return P
+
+    def pk_auc(self, events, t_end):
+        """Exact (n_subjects, n_pk) AUC over [0, t_end] of every PK column, independent of dt"""
+        x = self.initial_state()[:, :self.n_pk]
+        auc = np.zeros((self.n, self.n_pk))
+        for a, b, jump, rate in dose_segments(events, 0.0, t_end, self.n_pk):
+            x = x + jump
+            Gam, Psi = self.auc_propagator(b - a)
+            auc += np.einsum('sij,sj->si', Gam, x) + Psi @ rate
+            Phi, _ = self.propagator(b - a)
+            x = np.einsum('sij,sj->si', Phi, x) + Gam @ rate
+        return auc
+
+    def _integrate(self, events, t_end, dt, method='RK45'):
+        """Returns the dt grid and trajectories of shape (n_times, n_subjects, n_states)"""
+        if method == 'expm':
+            if self.qsp:
+                raise ValueError("method='expm' is only available for PK-only populations")
+            return self._integrate_expm(events, t_end, dt)
+        t_eval = time_grid(0.0, t_end, dt)
+        Y = np.empty((len(t_eval), self.n, self.n_states))
+        y = self.initial_state()
+        if method == 'LSODA':
+            # LSODA takes no sparse Jacobian and would build a dense one over every subject
+            method = 'BDF'
+        kw = {'jac': self.jac} if method in ('Radau', 'BDF') else {}
+        self.nfev = 0
+        for a, b, jump, rate in dose_segments(events, 0.0, t_end, self.n_pk):
+            y[:, :self.n_pk] += jump
+            lo, hi = np.searchsorted(t_eval, [a, b])
+            sol = solve_ivp(
+                fun=lambda t, y, rate=rate: self.odes(t, y, rate),
+                t_span=(a, b), y0=y.ravel(), t_eval=np.append(t_eval[lo:hi], b),
+                method=method, **kw
+            )
+            self.nfev += sol.nfev
+            Ys = sol.y.T.reshape(-1, self.n, self.n_states)
+            Y[lo:hi] = Ys[:-1]
+            y = Ys[-1].copy()
+        if np.isclose(t_eval[-1], t_end):
+            Y[-1] = y
+        return t_eval, Y
+
+    def _integrate_expm(self, events, t_end, dt):
+        t_eval = time_grid(0.0, t_end, dt)
+        Y = np.empty((len(t_eval), self.n, self.n_states))
+        x = self.initial_state()
+        Phi, Gam = self.propagator(dt)
+        self.nfev = 0
+        for a, b, jump, rate in dose_segments(events, 0.0, t_end, self.n_pk):
+            x = x + jump
+            lo, hi = np.searchsorted(t_eval, [a, b])
+            t = a
+            if lo < hi:
+                P0, G0 = self.propagator(t_eval[lo] - a)
+                x = Y[lo] = np.einsum('sij,sj->si', P0, x) + G0 @ rate
+                step = Gam @ rate
+                for k in range(lo + 1, hi):
+                    x = Y[k] = np.einsum('sij,sj->si', Phi, x) + step
+                t = t_eval[hi - 1]
+            P1, G1 = self.propagator(b - t)
+            x = np.einsum('sij,sj->si', P1, x) + G1 @ rate
+        if np.isclose(t_eval[-1], t_end):
+            Y[-1] = x
+        return t_eval, Y
+
+def total_dose(events, t_end):
+    return sum(ev.amount for ev in events if 0.0 <= ev.time < t_end)
+
+def pk_summary(t, conc, dose=None, auc=None):
+    """Per-subject NCA metrics for conc of shape (n_subjects, n_times); auc overrides the trapezoid"""
+    out = nca(t, conc, dose=dose, auc=auc)
+    out['AUC'] = out['AUC_0_t']
+    return out
+
+def _exact_auc(pop, events, t_end, comp):
+    """Exact per-subject AUC of a PK column (None for QSP columns, which keep the trapezoid)"""
+    return pop.pk_auc(events, t_end)[:, pop.names.index(comp)] if comp in pop.names else None
+
+def simulate_population(phys_array, cmpd, events, qsp_params=None, t_end=24.0, dt=0.1,
+                        method='RK45', comp='Blood', return_trajectories=False, tissues=None):
+    """Simulate every subject in one batched integration and return per-subject PK metrics"""
+    pop = PopulationSimulator(phys_array, cmpd, qsp_params=qsp_params, tissues=tissues)
+    t, Y = pop._integrate(events, t_end, dt, method=method)
+    out = pk_summary(t, Y[:, :, pop.columns().index(comp)].T, dose=total_dose(events, t_end),
+                     auc=_exact_auc(pop, events, t[-1], comp))
+    if return_trajectories:
+        out['Time_h'] = t
+        out['trajectories'] = Y.transpose(1, 0, 2)
+        out['columns'] = pop.columns()
+    return out
+
+def _simulate_chunk(shm_name, shape, lo, phys_chunk, cmpd, qsp_params, events, t_end, dt, method, tissues):
+    """Worker: simulate subjects lo.. one by one straight into the shared trajectory block"""
+    shm = SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        n = len(phys_chunk['V_blood'])
+        for i in range(n):
+            phys = Physiology(**{k: float(v[i]) for k, v in phys_chunk.items()})
+            sim = PBPKQSPSimulator(phys, cmpd, qsp_params=qsp_params, tissues=tissues)
+            _, out[lo + i] = sim._integrate(events, t_end, dt, method=method)
+        del out
+    finally:
+        shm.close()
+    return n
+
+def run_population_parallel(phys_array, cmpd, events, qsp_params=None, t_end=24.0, dt=0.1,
+                            method='RK45', n_workers=None, chunk_size=None, comp='Blood',
+                            return_trajectories=False, tissues=None):
+    """Simulate subjects independently across a process pool.
+
+    Each subject runs through PBPKQSPSimulator exactly as in a serial loop, so
+    results do not depend on n_workers or chunk_size; n_workers=1 runs in-process.
+    Workers write into a preallocated shared-memory (n_subjects, n_times, n_states)
+    block rather than returning DataFrames.
+    """
+    phys = physiology_arrays(phys_array)
+    n = len(phys['V_blood'])
+    n_workers = n_workers or os.cpu_count()
+    chunk_size = chunk_size or max(1, -(-n // (4*n_workers)))
+    t = time_grid(0.0, t_end, dt)
+    cols = PBPKQSPSimulator(Physiology(), cmpd, qsp_params=qsp_params, tissues=tissues).columns()
+    shape = (n, len(t), len(cols))
+    shm = SharedMemory(create=True, size=max(1, int(np.prod(shape))*8))
+    try:
+        traj = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        jobs = [(shm.name, shape, lo, {k: v[lo:lo + chunk_size] for k, v in phys.items()},
+                 cmpd, qsp_params, events, t_end, dt, method, tissues)
+                for lo in range(0, n, chunk_size)]
+        if n_workers == 1:
+            for job in jobs:
+                _simulate_chunk(*job)
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                for f in [pool.submit(_simulate_chunk, *job) for job in jobs]:
+                    f.result()
+        pop = PopulationSimulator(phys, cmpd, tissues=tissues)
+        out = pk_summary(t, traj[:, :, cols.index(comp)], dose=total_dose(events, t_end),
+                         auc=_exact_auc(pop, events, t[-1], comp))
+        if return_trajectories:
+            out['Time_h'] = t
+            out['trajectories'] = traj.copy()
+            out['columns'] = cols
+        del traj
+    finally:
+        shm.close()
+        shm.unlink()
+    return out
+
+def simulate_sampled_population(n, distributions, cmpd, events, base=None, seed=None, **kw):
+    """Sample n subjects from declared Physiology distributions and simulate them in one call"""
+    phys = sample_physiology(n, distributions, base=base, seed=seed)
+    out = simulate_population(phys, cmpd, events, **kw)
+    out['physiology'] = phys
+    return out
+
+def main():
+    cfg = load_config()
+    setup = model_from_config(cfg)
+    pop_cfg = cfg.get('population', {})
+    out = simulate_sampled_population(
+        int(pop_cfg.get('n_subjects', 1000)), pop_cfg.get('distributions', {}), setup.cmpd,
+        setup.events, base=setup.phys, seed=pop_cfg.get('seed'), qsp_params=setup.qsp,
+        tissues=setup.tissues)
+    for k in ('Cmax', 'Tmax', 'AUC'):
+        v = out[k]
+        print(f"{k}: median {np.median(v):.4g}  5-95% [{np.percentile(v, 5):.4g}, {np.percentile(v, 95):.4g}]")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import itertools
+import numpy as np
+import pandas as pd
+from scipy.signal import fftconvolve
+from app import DosingEvent, GUT, BLOOD, DOSE_TYPES, check_dose, time_grid
+from nca import nca
+
+ROUTES = DOSE_TYPES
+
+class RegimenEngine:
+    """Evaluate dosing regimens by superposing precomputed unit responses.
+
+    The PK block is linear, so a regimen's trajectory is the convolution of its
+    dose input with the unit-impulse responses H[k] = Phi(dt)**k, computed once
+    with the exact expm propagator. Every dose is first turned into the exact
+    state increment it produces at the next grid point (a bolus off the grid is
+    propagated to it, an infusion contributes its integrated input per grid
+    interval), so regimens with arbitrary dose times match simulate(method='expm')
+    to round-off. Batches are then combined by direct (Toeplitz) or FFT
+    convolution. With qsp_params set the system is no longer linear and every
+    regimen falls back to a full simulation.
+    """
+    def __init__(self, sim, t_end=24.0, dt=0.1):
+        self.sim = sim
+        self.t_end = t_end
+        self.dt = dt
+        self.t = time_grid(0.0, t_end, dt)
+        self.linear = not sim.qsp
+        self._toeplitz_cache = {}
+        if self.linear:
+            Phi, self.Gam = sim.propagator(dt)
+            H = np.empty((len(self.t), sim.n_pk, sim.n_pk))
+            H[0] = np.eye(sim.n_pk)
+            for k in range(1, len(self.t)):
+                H[k] = Phi @ H[k - 1]
+            self.H = H
+
+    def _next_grid(self, time):
+        """Index of the first grid point at or after time, and the gap to it"""
+        k = int(np.ceil(time/self.dt - 1e-9))
+        return k, k*self.dt - time
+
+    def inputs(self, regimens):
+        """Exact state increments at grid points, shape (n_regimens, n_times, n_pk)"""
+        n, n_pk = len(self.t), self.sim.n_pk
+        D = np.zeros((len(regimens), n, n_pk))
+        for i, events in enumerate(regimens):
+            for ev in events:
+                check_dose(ev)
+                if not 0.0 <= ev.time < self.t_end:
+                    continue
+                if ev.type == 'iv_infusion':
+                    self._add_infusion(D[i], ev.time, min(ev.time + ev.duration, self.t[-1]),
+                                       ev.amount/ev.duration)
+                else:
+                    k, gap = self._next_grid(ev.time)
+                    if k < n:
+                        Phi, _ = self.sim.propagator(gap)
+                        D[i, k] += ev.amount*Phi[:, GUT if ev.type == 'oral' else BLOOD]
+        return D
+
+    def _add_infusion(self, D, start, end, rate):
+        k0, gap0 = self._next_grid(start)
+        k1, gap1 = self._next_grid(end)
+        if k0 >= len(D) or end <= start:
+            return
+        if k0 == k1:
+            # Starts and stops inside one grid interval
+            P, _ = self.sim.propagator(gap1)
+            _, G = self.sim.propagator(end - start)
+            D[k1] += rate*(P @ G[:, BLOOD])
+            return
+        _, G = self.sim.propagator(gap0)
+        D[k0] += rate*G[:, BLOOD]
+        D[k0 + 1:k1] += rate*self.Gam[:, BLOOD]
+        if k1 < len(D):
+            P, _ = self.sim.propagator(gap1)
+            _, G = self.sim.propagator(self.dt - gap1)
+            D[k1] += rate*(P @ G[:, BLOOD])
+
+    def _toeplitz(self, comp):
+        """T[j, c, k, o] = H[k - j][o, c] for k >= j, so a whole batch is one tensordot"""
+        if comp not in self._toeplitz_cache:
+            H = self.H if comp is None else self.H[:, [self.sim.columns().index(comp)], :]
+            n = len(self.t)
+            lag = np.arange(n)[None, :] - np.arange(n)[:, None]
+            T = H[np.clip(lag, 0, None)]
+            T[lag < 0] = 0.0
+            self._toeplitz_cache[comp] = T.transpose(0, 3, 1, 2)
+        return self._toeplitz_cache[comp]
+
+    def evaluate(self, regimens, comp='Blood', method='auto'):
+        """Trajectories of comp (or all PK compartments if comp is None) for each regimen"""
+        if not self.linear:
+            out = np.stack([self.sim._integrate(events, self.t_end, self.dt)[1] for events in regimens])
+            return out[:, :, :self.sim.n_pk] if comp is None else out[:, :, self.sim.columns().index(comp)]
+        D = self.inputs(regimens)
+        n, n_pk = len(self.t), self.sim.n_pk
+        n_out = n_pk if comp is None else 1
+        if method == 'auto':
+            method = 'direct' if n*n*n_pk*n_out*8 <= 64*2**20 else 'fft'
+        if method == 'direct':
+            Y = np.tensordot(D, self._toeplitz(comp), axes=([1, 2], [0, 1]))
+        else:
+            H = self.H if comp is None else self.H[:, [self.sim.columns().index(comp)], :]
+            Y = np.zeros((len(regimens), n, n_out))
+            for c in np.flatnonzero(D.any(axis=(0, 1))):
+                Y += fftconvolve(D[:, :, None, c], H[None, :, :, c], axes=1)[:, :n]
+        return Y if comp is None else Y[:, :, 0]
+
+    def sweep(self, doses, intervals, routes=ROUTES, n_doses=None, infusion_duration=1.0,
+              comp='Blood', method='auto'):
+        """Evaluate every dose x interval x route combination and summarise with NCA.
+
+        Without n_doses each regimen repeats until t_end.
+        """
+        params, regimens = [], []
+        for dose, tau, route in itertools.product(doses, intervals, routes):
+            k = min(n_doses or np.inf, int(np.ceil(self.t_end/tau)))
+            dur = infusion_duration if route == 'iv_infusion' else 0.0
+            regimens.append([DosingEvent(route, dose, j*tau, dur) for j in range(k)])
+            params.append((dose, tau, route, k, dose*k))
+        conc = self.evaluate(regimens, comp=comp, method=method)
+        res = pd.DataFrame(params, columns=['dose', 'interval', 'route', 'n_doses', 'total_dose'])
+        for key, v in nca(self.t, conc, dose=res['total_dose'].to_numpy()).items():
+            res[key] = v
+        return res, conc